@@ -0,0 +1,166 @@
+from validation import QueryRange, ValidationResult, ValidationQuery, common_timestamps, keep_timestamps, ratio
+from typing import NamedTuple, Callable, List, Dict, Optional
+import numpy as np
+import tempfile
+import tracemalloc
+import subprocess
+import sys
+import time
+import json
+import gc
+import os
+
+# timings and peak memory of the validation hot paths over growing series, compared against a stored baseline
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+# a case is flagged when it is this much slower, or uses this much more memory, than its baseline
+DEFAULT_TOLERANCE = 0.25
+
+class Case(NamedTuple):
+    name: str
+    # builds the inputs for one size outside of the measurement
+    setup: Callable[[int], tuple]
+    run: Callable
+
+class Measurement(NamedTuple):
+    case: str
+    size: int
+    seconds: float
+    peak_bytes: int
+
+class Regression(NamedTuple):
+    measurement: Measurement
+    baseline: Measurement
+    reason: str
+
+def _ranges(size: int):
+    # two scrape grids that only partly overlap, as node exporter and kepler series do
+    rng = np.random.default_rng(size)
+    timestamps = 1_700_000_000 + 3 * np.arange(size, dtype=np.int64)
+    shifted = timestamps[size // 10:] + np.where(np.arange(size - size // 10) % 4 == 0, 1, 0)
+    range_one = QueryRange.from_arrays("one", timestamps, rng.random(size))
+    range_two = QueryRange.from_arrays("two", shifted, rng.random(shifted.size) + 0.5)
+    return range_one, range_two
+
+def _result(size: int) -> ValidationResult:
+    rng = np.random.default_rng(size)
+    actual = rng.random(size) * 100 + 1
+    return ValidationResult(
+        vq=ValidationQuery(actual_query_name="actual", predicted_query_name="predicted"),
+        predicted=actual * (1 + 0.05 * rng.standard_normal(size)),
+        actual=actual
+    )
+
+def _error_result(result: ValidationResult):
+    from output import ErrorResult
+    return ErrorResult(result)
+
+def _generate_graph(result: ValidationResult):
+    # a fresh directory per run, removed with the png, costs well under a millisecond next to the plot
+    from output import GraphedResult
+    with tempfile.TemporaryDirectory(prefix="metrics_validator_benchmark_") as save_path:
+        GraphedResult(result, save_path).generate_graph()
+
+CASES = [
+    Case("common_timestamps", _ranges, common_timestamps),
+    Case("keep_timestamps", lambda size: (common_timestamps(*_ranges(size)), _ranges(size)[1]), keep_timestamps),
+    # the target / total cpu time ratio of process.power.NodeExporter
+    Case("cpu_time_ratio", _ranges, ratio),
+    Case("error_result", lambda size: (_result(size),), _error_result),
+    Case("generate_graph", lambda size: (_result(size),), _generate_graph),
+]
+
+def measure(case: Case, size: int, repeat: int) -> Measurement:
+    args = case.setup(size)
+    # best of repeat untraced runs for time, then one traced run for peak memory
+    seconds = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        case.run(*args)
+        seconds.append(time.perf_counter() - started)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        case.run(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Measurement(case.name, size, min(seconds), peak)
+
+def run(cases: List[Case], sizes: List[int], repeat: Optional[int] = None) -> List[Measurement]:
+    measurements = []
+    for case in cases:
+        for size in sizes:
+            # large inputs take long enough that one run is representative
+            measurement = measure(case, size, repeat or (5 if size <= 100_000 else 1))
+            print(f"{measurement.case:>20}  {measurement.size:>10}  {measurement.seconds * 1000:>12.3f} ms  {measurement.peak_bytes / 2**20:>10.2f} MiB")
+            measurements.append(measurement)
+    return measurements
+
+def load_baseline(path: str) -> Dict[tuple, Measurement]:
+    with open(path, "r") as f:
+        return {(entry["case"], entry["size"]): Measurement(**entry) for entry in json.load(f)["measurements"]}
+
+def save_baseline(path: str, measurements: List[Measurement]) -> None:
+    # merged into any existing baseline so partial runs only update what they measured
+    baseline = load_baseline(path) if os.path.exists(path) else {}
+    baseline.update({(measurement.case, measurement.size): measurement for measurement in measurements})
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"measurements": [measurement._asdict() for measurement in sorted(baseline.values())]}, f, indent=2)
+    os.replace(temp_path, path)
+
+def compare(measurements: List[Measurement], baseline: Dict[tuple, Measurement], tolerance: float = DEFAULT_TOLERANCE) -> List[Regression]:
+    regressions = []
+    for measurement in measurements:
+        base = baseline.get((measurement.case, measurement.size))
+        if base is None:
+            continue
+        if measurement.seconds > base.seconds * (1 + tolerance):
+            regressions.append(Regression(measurement, base, f"time {measurement.seconds / base.seconds:.2f}x baseline"))
+        if measurement.peak_bytes > base.peak_bytes * (1 + tolerance):
+            regressions.append(Regression(measurement, base, f"peak memory {measurement.peak_bytes / max(base.peak_bytes, 1):.2f}x baseline"))
+    return regressions
+
+# modules no command needs just to start, each subsystem loads its own when used
+HEAVY_MODULES = ("docker", "matplotlib", "sklearn", "psutil", "aiohttp", "prometheus_api_client")
+IMPORT_BUDGET_SECONDS = 0.5
+IMPORT_CHECK_MODULES = ("cli", "runner", "validation", "prometheus", "stresser", "output", "process.power", "process.cpu_time")
+
+class ImportCheck(NamedTuple):
+    module: str
+    seconds: float
+    heavy_modules: List[str]
+
+_IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+print(json.dumps([time.perf_counter() - started, [name for name in {heavy!r} if name in sys.modules]]))
+"""
+
+def check_imports(modules=IMPORT_CHECK_MODULES, repeat: int = 3) -> List[ImportCheck]:
+    # every module is imported in a fresh interpreter, best of repeat
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    checks = []
+    for module in modules:
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run(
+                [sys.executable, "-c", _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                cwd=package_dir, capture_output=True, text=True, check=True
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        seconds, heavy_modules = min(runs, key=lambda run: run[0])
+        checks.append(ImportCheck(module, seconds, heavy_modules))
+    return checks
+
+def import_violations(checks: List[ImportCheck], budget: float = IMPORT_BUDGET_SECONDS) -> List[str]:
+    violations = []
+    for check in checks:
+        if check.seconds > budget:
+            violations.append(f"import {check.module} took {check.seconds:.3f}s, budget is {budget:.3f}s")
+        if check.heavy_modules:
+            violations.append(f"import {check.module} loads {', '.join(check.heavy_modules)}")
+    return violations
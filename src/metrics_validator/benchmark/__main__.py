@@ -0,0 +1,52 @@
+from benchmark import CASES, DEFAULT_SIZES, DEFAULT_TOLERANCE, IMPORT_BUDGET_SECONDS, run, load_baseline, save_baseline, compare, check_imports, import_violations
+import argparse
+import sys
+import os
+
+# python -m benchmark --sizes 1e3,1e5 --cases common_timestamps,cpu_time_ratio
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the validation hot paths")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="comma separated series lengths")
+    parser.add_argument("--cases", default="", help="comma separated case names, all by default")
+    parser.add_argument("--repeat", type=int, default=0, help="timed runs per case, best is kept")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(__file__), "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--require-baseline", action="store_true", help="fail when the baseline or any measured case in it is missing, for ci")
+    parser.add_argument("--imports", action="store_true", help="check start up import times against the budget instead")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_SECONDS)
+    args = parser.parse_args()
+
+    if args.imports:
+        checks = check_imports()
+        for check in checks:
+            print(f"{check.module:>20}  {check.seconds * 1000:>10.1f} ms  {', '.join(check.heavy_modules)}")
+        violations = import_violations(checks, args.import_budget)
+        for violation in violations:
+            print(f"IMPORT BUDGET {violation}")
+        sys.exit(1 if violations else 0)
+
+    sizes = [int(float(size)) for size in args.sizes.split(",") if size]
+    names = [name for name in args.cases.split(",") if name]
+    unknown = set(names) - {case.name for case in CASES}
+    if unknown:
+        parser.error(f"unknown cases: {sorted(unknown)}")
+    cases = [case for case in CASES if not names or case.name in names]
+
+    measurements = run(cases, sizes, args.repeat or None)
+    if args.save_baseline:
+        save_baseline(args.baseline, measurements)
+        print(f"baseline saved to {args.baseline}")
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, rerun with --save-baseline to record one")
+        sys.exit(1 if args.require_baseline else 0)
+    baseline = load_baseline(args.baseline)
+    # without a baseline entry a case can never be flagged, ci treats that as a failure
+    missing = [measurement for measurement in measurements if (measurement.case, measurement.size) not in baseline]
+    for measurement in missing:
+        print(f"NO BASELINE {measurement.case} at {measurement.size}")
+    regressions = compare(measurements, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression.measurement.case} at {regression.measurement.size}: {regression.reason}")
+    sys.exit(1 if regressions or (missing and args.require_baseline) else 0)
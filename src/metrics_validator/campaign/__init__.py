@@ -0,0 +1,68 @@
+from validation import Validator, ValidationResult
+from stresser import Local, time_interval_log_name
+from utils import parse_cpu_list
+from instrumentation import debug, logger
+from typing import NamedTuple, List, Optional, Dict, Set
+import asyncio
+import os
+
+class CampaignRun(NamedTuple):
+    name: str
+    # a validator driving a Process stresser, e.g. process.power.NodeExporter
+    validator: Validator
+
+class CampaignResult(NamedTuple):
+    name: str
+    isolated_cpus: Set[int]
+    result: Optional[ValidationResult]
+    error: str
+
+def split_across_cpus(config: Local, isolated_cpus: List[str]) -> List[Local]:
+    # one copy of a load curve per isolated cpu set, each with its own time interval log
+    return [
+        config._replace(
+            isolated_cpu=cpus,
+            time_interval_log_name=time_interval_log_name(cpus)
+        )
+        for cpus in isolated_cpus
+    ]
+
+class Campaign:
+    # runs many validations at once, each pinned to its own isolated cpus. runs whose cpus overlap
+    # are serialized by per-cpu locks, disjoint runs proceed in parallel
+    def __init__(self, runs: List[CampaignRun], max_parallel: int = 0):
+        self.runs = runs
+        self.max_parallel = max_parallel or len(runs) or 1
+        self.run_cpus = [parse_cpu_list(run.validator.stress_process.isolated_cpu) for run in runs]
+        for run, cpus in zip(runs, self.run_cpus):
+            if not cpus:
+                raise ValueError(f"campaign run {run.name} is not pinned to any isolated cpu")
+        logs: Dict[str, str] = {}
+        for run in runs:
+            log = os.path.abspath(run.validator.stress_process.time_range_log)
+            if log in logs:
+                raise ValueError(f"campaign runs {logs[log]} and {run.name} both write {log}")
+            logs[log] = run.name
+        self._cpu_locks = {cpu: asyncio.Lock() for cpus in self.run_cpus for cpu in cpus}
+
+    async def run(self) -> List[CampaignResult]:
+        # every run is a task on one event loop, the semaphore bounds how many stress at once
+        slots = asyncio.Semaphore(self.max_parallel)
+        return list(await asyncio.gather(*(self._run_one(run, cpus, slots) for run, cpus in zip(self.runs, self.run_cpus))))
+
+    async def _run_one(self, run: CampaignRun, cpus: Set[int], slots: asyncio.Semaphore) -> CampaignResult:
+        # locks are always taken in cpu order so overlapping runs cannot deadlock
+        locks = [self._cpu_locks[cpu] for cpu in sorted(cpus)]
+        async with slots:
+            for lock in locks:
+                await lock.acquire()
+            try:
+                debug("campaign run starting", run=run.name, cpus=sorted(cpus))
+                return CampaignResult(run.name, cpus, await run.validator.validate(), "")
+            except Exception as e:
+                logger.error(f"campaign: {run.name} failed: {e}")
+                return CampaignResult(run.name, cpus, None, str(e))
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+
@@ -0,0 +1,231 @@
+from typing import List, Optional
+from instrumentation import tracer, span, profile, logger, PROFILE_MODES
+import argparse
+import asyncio
+import logging
+import sys
+
+# command line entry point, python -m cli <command>. every command imports the subsystems it uses
+# inside its handler, so starting up never pays for docker, matplotlib or the prometheus client it does not need
+
+def _add_prometheus_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--prom-url", default="http://localhost:9091/")
+    parser.add_argument("--disable-ssl", action="store_true")
+    parser.add_argument("--max-concurrency", type=int, default=6)
+    parser.add_argument("--cache-dir", default="", help="cache settled query results here")
+
+def _add_validation_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--rate-interval", default="20s")
+    parser.add_argument("--step", default="3s")
+    parser.add_argument("--join-mode", default="exact", choices=["exact", "nearest", "asof"])
+    parser.add_argument("--join-tolerance", type=int, default=0)
+    parser.add_argument("--graph-dir", default="", help="save a graph of predicted and actual here")
+    parser.add_argument("--show", action="store_true", help="show the graph")
+    parser.add_argument("--store", default="", help="keep the result in the result store at this directory")
+    parser.add_argument("--kepler-build", default="", help="kepler build or version under test, recorded with the stored result")
+
+def _add_phase_arguments(parser: argparse.ArgumentParser) -> None:
+    # process validators only, the container stressor logs no phases and its queries are not planned
+    parser.add_argument("--by-phase", action="store_true", help="score only the steady state of each load phase")
+    parser.add_argument("--phase-settle", default="0s", help="skip this long after the first full rate window of a phase")
+    parser.add_argument("--phase-loads", default="", help="comma separated load levels to score, all by default")
+    parser.add_argument("--verify", action="store_true", help="cross check locally computed expressions against prometheus")
+
+def _add_instrumentation_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("-v", "--verbose", action="store_true", help="log debug messages to stderr")
+    parser.add_argument("--trace", default="", help="write the json trace of every timed phase here")
+    parser.add_argument("--metrics-file", default="", help="write the validator's own metrics here in prometheus text format")
+    parser.add_argument("--profile", default="", choices=PROFILE_MODES, help="profile the validation with cprofile or tracemalloc")
+    parser.add_argument("--profile-output", default="", help="profile statistics file, stderr by default")
+
+def _add_stress_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--isolated-cpu", default="5", help="taskset cpu list the stressor is pinned to")
+    parser.add_argument("--load-curve", default="0:20,50:30,100:30,50:30,0:20")
+    parser.add_argument("--iterations", default="1")
+    parser.add_argument("--mount-dir", default="/tmp")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="metrics_validator", description="validate kepler's exported metrics")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    process = commands.add_parser("process", help="validate per process metrics against a local stressor")
+    process_commands = process.add_subparsers(dest="metric", required=True)
+    power = process_commands.add_parser("power", help="kepler process package power against its share of node rapl power")
+    cpu_time = process_commands.add_parser("cpu-time", help="kepler process cpu time against node exporter cpu time")
+    for subparser in (power, cpu_time):
+        _add_prometheus_arguments(subparser)
+        _add_validation_arguments(subparser)
+        _add_phase_arguments(subparser)
+        _add_stress_arguments(subparser)
+        _add_instrumentation_arguments(subparser)
+    power.add_argument("--local-rate", action="store_true", help="fetch raw counters and evaluate rate() locally")
+    power.set_defaults(handler=_process_power)
+    cpu_time.set_defaults(handler=_process_cpu_time)
+
+    container = commands.add_parser("container", help="kepler container cpu time against node exporter cpu time")
+    _add_prometheus_arguments(container)
+    _add_validation_arguments(container)
+    _add_instrumentation_arguments(container)
+    container.add_argument("--isolated-cpus", default="15", help="comma separated cpus the container is pinned to")
+    container.add_argument("--stress-script", default="stress_script.sh")
+    container.add_argument("--container-name", default="kepler-stress-test-container")
+    container.set_defaults(handler=_container)
+
+    matrix = commands.add_parser("matrix", help="run or resume a validation matrix from a json or yaml file")
+    matrix.add_argument("config")
+    _add_instrumentation_arguments(matrix)
+    matrix.set_defaults(handler=_matrix)
+
+    report = commands.add_parser("report", help="summarize a matrix checkpoint")
+    report.add_argument("checkpoint")
+    report.set_defaults(handler=_report)
+
+    history = commands.add_parser("history", help="compare stored results across runs")
+    history.add_argument("store")
+    history.add_argument("--group-by", default="kepler_build")
+    history.add_argument("--since", default="", help="iso timestamp of the oldest run to include")
+    history.add_argument("--filter", action="append", default=[], metavar="FIELD=VALUE", help="only runs with this metadata value")
+    history.set_defaults(handler=_history)
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if getattr(args, "verbose", False):
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+    try:
+        return args.handler(args) or 0
+    finally:
+        _export_instrumentation(args)
+
+def _export_instrumentation(args: argparse.Namespace) -> None:
+    if getattr(args, "trace", ""):
+        tracer.export_trace(args.trace)
+    if getattr(args, "metrics_file", ""):
+        tracer.export_metrics(args.metrics_file)
+    if getattr(args, "verbose", False):
+        print(tracer.summary(), file=sys.stderr)
+
+def _prom_config(args: argparse.Namespace):
+    from prometheus import PromConfig
+    return PromConfig(url=args.prom_url, disable_ssl=args.disable_ssl, max_concurrency=args.max_concurrency, cache_dir=args.cache_dir)
+
+def _validation_config(args: argparse.Namespace, isolated_cpus: List[str], local_rate: bool = False):
+    from validation import ValidationConfig, ValidationQuery
+    from stresser import StressProcessConfig
+    return ValidationConfig(
+        vq=ValidationQuery(actual_query_name="actual", predicted_query_name="predicted"),
+        sc=StressProcessConfig(isolated_cpus=isolated_cpus, stress_load=100, stresser_timeout=120),
+        rate_interval=args.rate_interval,
+        join_mode=args.join_mode,
+        join_tolerance=args.join_tolerance,
+        step=args.step,
+        local_rate=local_rate,
+        by_phase=getattr(args, "by_phase", False),
+        phase_settle=getattr(args, "phase_settle", "0s"),
+        phase_loads=tuple(int(load) for load in getattr(args, "phase_loads", "").split(",") if load),
+        verify=getattr(args, "verify", False)
+    )
+
+def _local(args: argparse.Namespace):
+    from stresser import Local
+    return Local(
+        isolated_cpu=args.isolated_cpu,
+        load_curve=args.load_curve,
+        iterations=args.iterations,
+        container_name="",
+        mount_dir=args.mount_dir
+    )
+
+def _run_validator(validator, args: argparse.Namespace) -> int:
+    from output import ErrorResult
+    result = asyncio.run(_validate(validator, args))
+    if result is None or len(result.actual) == 0:
+        print("validation produced no aligned samples")
+        return 1
+    print(ErrorResult(result))
+    if args.store:
+        from store import ResultStore, validator_metadata
+        meta = ResultStore(args.store).save(result, kepler_build=args.kepler_build, **validator_metadata(validator))
+        print(f"stored as run {meta.run_id}")
+    if result.loads is not None:
+        for load, error_result in ErrorResult.by_load(result).items():
+            print(f"load {load}%: {error_result}")
+    if args.graph_dir or args.show:
+        from output import GraphedResult
+        filepath = GraphedResult(result, args.graph_dir).generate_graph(args.show)
+        if filepath:
+            print(f"graph saved to {filepath}")
+    return 0
+
+async def _validate(validator, args: argparse.Namespace):
+    try:
+        with span("validate", validator=type(validator).__name__):
+            async with profile(args.profile, args.profile_output):
+                return await validator.validate()
+    finally:
+        await validator.prom.close()
+
+def _process_power(args: argparse.Namespace) -> int:
+    from prometheus import PromConnect
+    import process.power as p
+    validator = p.NodeExporter(
+        prom=PromConnect(_prom_config(args)),
+        vc=_validation_config(args, args.isolated_cpu.split(","), args.local_rate),
+        config=_local(args)
+    )
+    return _run_validator(validator, args)
+
+def _process_cpu_time(args: argparse.Namespace) -> int:
+    from prometheus import PromConnect
+    import process.cpu_time as ct
+    validator = ct.NodeExporter(
+        prom=PromConnect(_prom_config(args)),
+        vc=_validation_config(args, args.isolated_cpu.split(",")),
+        config=_local(args)
+    )
+    return _run_validator(validator, args)
+
+def _container(args: argparse.Namespace) -> int:
+    from prometheus import PromConnect
+    from stresser import StressContainerConfig
+    from container.one_to_one import ContainerValidator
+    isolated_cpus = args.isolated_cpus.split(",")
+    validator = ContainerValidator(
+        prom=PromConnect(_prom_config(args)),
+        sc=StressContainerConfig(
+            isolated_cpus=isolated_cpus,
+            stress_script=args.stress_script,
+            container_name=args.container_name
+        ),
+        vc=_validation_config(args, isolated_cpus)
+    )
+    return _run_validator(validator, args)
+
+def _matrix(args: argparse.Namespace) -> int:
+    from runner import MatrixRunner, load_matrix, format_summary
+    records = asyncio.run(_run_matrix(MatrixRunner(load_matrix(args.config)), args))
+    print(format_summary(records))
+    return 0 if all(record["status"] == "done" for record in records.values()) else 1
+
+async def _run_matrix(runner, args: argparse.Namespace):
+    async with profile(args.profile, args.profile_output):
+        return await runner.run()
+
+def _report(args: argparse.Namespace) -> int:
+    import json
+    from runner import format_summary
+    with open(args.checkpoint, "r") as f:
+        print(format_summary(json.load(f)["jobs"]))
+    return 0
+
+def _history(args: argparse.Namespace) -> int:
+    from store import ResultStore, compare_runs
+    filters = dict(entry.split("=", 1) for entry in args.filter)
+    groups = compare_runs(ResultStore(args.store), args.group_by, since=args.since, **filters)
+    for key, group in sorted(groups.items()):
+        print(f"{args.group_by}={key or '-'}: {group['runs']} runs, {group['samples']} samples, "
+              f"mae {group['mae']:.4f}, mape {group['mape']:.4%}, rmse {group['rmse']:.4f}")
+    return 0
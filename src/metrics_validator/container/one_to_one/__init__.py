@@ -1,64 +1,54 @@
-from validation import QueryRange, Validator, ValidationResult, common_timestamps, keep_timestamps, ValidationQuery
-from prometheus import PromConnect
+from validation import ValidationConfig, Validator, ValidationResult, align, ValidationQuery
+from prometheus import PromConnect, RangeRequest
 from stresser import StressContainer, StressContainerConfig
+from instrumentation import debug, logger
+from typing import Optional
 import subprocess
-from datetime import datetime
-from typing import Iterable
 
 class ContainerValidator(Validator):
-    def __init__(self, prom: PromConnect, sc: StressContainerConfig): #rate_interval="20s", #prom_url="http://localhost:9090", isolated_cpu=15, stress_load=100, stresser_timeout=120):
+    def __init__(self, prom: PromConnect, sc: StressContainerConfig, vc: Optional[ValidationConfig] = None):
         self.prom = prom
-        self.rate_interval = "20s"
-        self.isolated_cpus = ["15"]
+        # node exporter is read on the cpus the container is pinned to
+        self.isolated_cpus = sc.isolated_cpus
+        self.rate_interval = vc.rate_interval if vc else "20s"
+        self.step = vc.step if vc else "3s"
+        self.join_mode = vc.join_mode if vc else "exact"
+        self.join_tolerance = vc.join_tolerance if vc else 0
         self.stress_container = StressContainer(sc)
 
-    def validate(self) -> ValidationResult:
+    async def validate(self) -> ValidationResult:
         try: 
-            stress_output = self.stress_container.stress()
-            kepler_process_cpu_time = self._retrieve_kepler_container_cpu_time(stress_output.start_time, stress_output.end_time, stress_output.container_id)
-            node_exporter_cpu_time = self._retrieve_node_cpu_time(stress_output.start_time, stress_output.end_time)
+            stress_output = await self.stress_container.stress()
+            kepler_process_cpu_time, node_exporter_cpu_time = await self.prom.get_metric_ranges([
+                RangeRequest(self._kepler_container_cpu_time_query(stress_output.container_id), stress_output.start_time, stress_output.end_time, self.step),
+                RangeRequest(self._node_cpu_time_query(), stress_output.start_time, stress_output.end_time, self.step),
+            ])
 
-            common_timestamp_set = common_timestamps(kepler_process_cpu_time, node_exporter_cpu_time)
-            kepler_process_cpu_time = keep_timestamps(common_timestamp_set, kepler_process_cpu_time)
-            node_exporter_cpu_time = keep_timestamps(common_timestamp_set, node_exporter_cpu_time)
-            # aligned_kepler_process_cpu_time_datapoints = [DataPoint(datapoint.timestamp, datapoint.value) for datapoint in kepler_process_cpu_time.values if datapoint.timestamp in common_timestamp_set]
-            # aligned_kepler_process_cpu_time_datapoints.sort(key=lambda datapoint: datapoint.timestamp)
-            # kepler_process_cpu_time = QueryRange(kepler_process_cpu_time.query, aligned_kepler_process_cpu_time_datapoints)
-
-            # aligned_kepler_node_cpu_time_datapoints = [DataPoint(datapoint.timestamp, datapoint.value) for datapoint in node_exporter_cpu_time.values if datapoint.timestamp in common_timestamp_set]
-            # aligned_kepler_node_cpu_time_datapoints.sort(key=lambda datapoint: datapoint.timestamp)
-
-            # node_exporter_cpu_time = QueryRange(node_exporter_cpu_time.query, aligned_kepler_node_cpu_time_datapoints)
+            kepler_process_cpu_time, node_exporter_cpu_time = align(
+                kepler_process_cpu_time, node_exporter_cpu_time,
+                mode=self.join_mode,
+                tolerance=self.join_tolerance
+            )
             validation_query = ValidationQuery(
                 actual_query_name=node_exporter_cpu_time.query,
                 predicted_query_name=kepler_process_cpu_time.query
             )
             return ValidationResult(
                 vq=validation_query,
-                predicted=[datapoint.value for datapoint in kepler_process_cpu_time.values],
-                actual=[datapoint.value for datapoint in node_exporter_cpu_time.values]
+                predicted=kepler_process_cpu_time.samples,
+                actual=node_exporter_cpu_time.samples,
+                timestamps=node_exporter_cpu_time.timestamps
             )
         except subprocess.CalledProcessError as e:
-            print(f"Stress failed: {e}")
+            logger.error(f"Stress failed: {e}")
 
-    def _retrieve_kepler_container_cpu_time(self, start: datetime, end: datetime, container_id: str) -> QueryRange:
+    def _kepler_container_cpu_time_query(self, container_id: str) -> str:
         query = f'sum(rate(kepler_container_bpf_cpu_time_ms_total{{container_id="{container_id}"}}[{self.rate_interval}]))'
-        print(query)
-        print(start)
-        print(end)
-        return self.prom.get_metric_range(
-            query=query,
-            start=start,
-            end=end
-        )
+        debug("kepler container cpu time query", query=query)
+        return query
 
-    def _retrieve_node_cpu_time(self, start: datetime, end: datetime) -> QueryRange:
-        #query = f'sum(rate(node_cpu_seconds_total{{cpu="{self.isolated_cpu}", mode!~"idle|system"}}[{self.rate_interval}])) * 1000'
+    def _node_cpu_time_query(self) -> str:
         cpu_label = "|".join(map(str, self.isolated_cpus))
         query = f'sum(rate(node_cpu_seconds_total{{cpu=~"{cpu_label}", mode!="idle"}}[{self.rate_interval}])) * 1000'
-        print(query)
-        return self.prom.get_metric_range(
-            query=query,
-            start=start,
-            end=end
-        )
\ No newline at end of file
+        debug("node exporter cpu time query", query=query)
+        return query
\ No newline at end of file
@@ -0,0 +1,228 @@
+from contextlib import contextmanager, asynccontextmanager
+from collections import deque
+from contextvars import ContextVar
+from typing import NamedTuple, Dict, List, Optional, Any, Iterator, AsyncIterator
+import itertools
+import threading
+import logging
+import json
+import time
+import sys
+import os
+
+# spans for the phases of a validation: stress execution, pid tracking, every prometheus query, alignment,
+# metric computation and plotting. each span records its wall time, its parent and free form attributes,
+# debug messages are attached to the span they happen in. the trace exports as json, and the per span totals
+# as prometheus metrics for the validator itself. only the standard library is imported here, the command
+# line imports this on startup
+
+logger = logging.getLogger("metrics_validator")
+
+# recent spans kept for the json trace, the per span totals behind the metrics are never dropped
+MAX_SPANS = 100000
+# numeric span attributes summed into <prefix>_span_<attribute>_total counters
+COUNTED_ATTRIBUTES = ("bytes", "wire_bytes", "samples", "series", "pids")
+METRICS_PREFIX = "metrics_validator"
+PROFILE_MODES = ("cprofile", "tracemalloc")
+# lines of cprofile or tracemalloc statistics reported when no output file is given
+PROFILE_TOP = 30
+
+class Event(NamedTuple):
+    time: float
+    message: str
+    attributes: Dict[str, Any]
+
+class Span:
+    # one timed phase, attributes can be added while it runs
+    def __init__(self, name: str, span_id: int, parent_id: Optional[int], attributes: Dict[str, Any]):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.events: List[Event] = []
+        self.start = time.time()
+        self.duration = 0.0
+        self.error = ""
+        self._started = time.perf_counter()
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def _finish(self) -> None:
+        self.duration = time.perf_counter() - self._started
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes,
+            "events": [event._asdict() for event in self.events],
+        }
+
+class SpanTotals:
+    count: int
+    seconds: float
+    errors: int
+    attributes: Dict[str, float]
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.errors = 0
+        self.attributes = {}
+
+# the innermost open span of the running task or thread, asyncio tasks and to_thread calls inherit it
+_current: ContextVar[Optional[Span]] = ContextVar("metrics_validator_span", default=None)
+
+class Tracer:
+    def __init__(self, max_spans: int = MAX_SPANS):
+        self.spans: deque = deque(maxlen=max_spans)
+        self.totals: Dict[str, SpanTotals] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        # works around synchronous code and across awaits alike
+        parent = _current.get()
+        span = Span(name, next(self._ids), parent.span_id if parent else None, attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span._finish()
+            _current.reset(token)
+            self._record(span)
+
+    def debug(self, message: str, **attributes) -> None:
+        # attached to the open span instead of printed, also handed to the logger for -v
+        span = _current.get()
+        if span is not None:
+            span.events.append(Event(time.time(), message, attributes))
+        if logger.isEnabledFor(logging.DEBUG):
+            details = " ".join(f"{key}={value}" for key, value in attributes.items())
+            logger.debug(f"{span.name + ': ' if span else ''}{message}{' ' + details if details else ''}")
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spans.clear()
+            self.totals.clear()
+
+    def _record(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+            totals = self.totals.setdefault(span.name, SpanTotals())
+            totals.count += 1
+            totals.seconds += span.duration
+            totals.errors += bool(span.error)
+            for attribute in COUNTED_ATTRIBUTES:
+                value = span.attributes.get(attribute)
+                if isinstance(value, (int, float)):
+                    totals.attributes[attribute] = totals.attributes.get(attribute, 0) + value
+
+    def trace(self) -> dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return {"spans": [span.as_dict() for span in spans]}
+
+    def export_trace(self, path: str) -> None:
+        with open(os.path.expanduser(path), "w") as f:
+            json.dump(self.trace(), f, indent=2, default=str)
+
+    def metrics(self) -> str:
+        # prometheus text exposition format, e.g. for the node exporter textfile collector
+        with self._lock:
+            totals = sorted(self.totals.items())
+        lines = [
+            f"# HELP {METRICS_PREFIX}_span_seconds Wall time spent in each validation phase.",
+            f"# TYPE {METRICS_PREFIX}_span_seconds summary",
+        ]
+        for name, total in totals:
+            lines.append(f'{METRICS_PREFIX}_span_seconds_sum{{span="{_escape(name)}"}} {total.seconds}')
+            lines.append(f'{METRICS_PREFIX}_span_seconds_count{{span="{_escape(name)}"}} {total.count}')
+        lines += [
+            f"# HELP {METRICS_PREFIX}_span_errors_total Spans that ended with an exception.",
+            f"# TYPE {METRICS_PREFIX}_span_errors_total counter",
+        ]
+        lines += [f'{METRICS_PREFIX}_span_errors_total{{span="{_escape(name)}"}} {total.errors}' for name, total in totals]
+        for attribute in COUNTED_ATTRIBUTES:
+            counted = [(name, total.attributes[attribute]) for name, total in totals if attribute in total.attributes]
+            if not counted:
+                continue
+            lines += [
+                f"# HELP {METRICS_PREFIX}_span_{attribute}_total Sum of the {attribute} attribute of each phase.",
+                f"# TYPE {METRICS_PREFIX}_span_{attribute}_total counter",
+            ]
+            lines += [f'{METRICS_PREFIX}_span_{attribute}_total{{span="{_escape(name)}"}} {value}' for name, value in counted]
+        return "\n".join(lines) + "\n"
+
+    def export_metrics(self, path: str) -> None:
+        # written to a temp file and renamed, a scraping collector never reads half a file
+        path = os.path.expanduser(path)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.metrics())
+        os.replace(temp_path, path)
+
+    def summary(self) -> str:
+        with self._lock:
+            totals = sorted(self.totals.items(), key=lambda item: -item[1].seconds)
+        return "\n".join(f"{name}: {total.count}x, {total.seconds:.3f}s" for name, total in totals)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# the tracer every module records into
+tracer = Tracer()
+
+def span(name: str, **attributes):
+    return tracer.span(name, **attributes)
+
+def debug(message: str, **attributes) -> None:
+    tracer.debug(message, **attributes)
+
+@asynccontextmanager
+async def profile(mode: str = "", output: str = "") -> AsyncIterator[None]:
+    # opt-in profiling of everything awaited inside, cprofile timings or tracemalloc allocations.
+    # statistics go to output when given (a pstats file for cprofile, text for tracemalloc), stderr otherwise
+    if not mode:
+        yield
+        return
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"unknown profile mode {mode}, expected one of {PROFILE_MODES}")
+    if mode == "cprofile":
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if output:
+                profiler.dump_stats(os.path.expanduser(output))
+            else:
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    else:
+        import tracemalloc
+        tracemalloc.start(25)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = [f"traced memory: {current / 2**20:.1f} MiB current, {peak / 2**20:.1f} MiB peak"]
+            lines += [str(statistic) for statistic in snapshot.statistics("lineno")[:PROFILE_TOP]]
+            if output:
+                with open(os.path.expanduser(output), "w") as f:
+                    f.write("\n".join(lines) + "\n")
+            else:
+                print("\n".join(lines), file=sys.stderr)
@@ -5,10 +5,15 @@ from prometheus import PromConnect, PromConfig
 from validation import ValidationConfig, ValidationQuery
 from stresser import StressProcessConfig, Local
 from container.one_to_one import ContainerValidator
+from cli import main
 import asyncio
+import sys
 
 # everything here should be in cli
 if __name__ == "__main__":
+    # with arguments this is the cli, e.g. python main.py matrix matrix.yaml
+    if len(sys.argv) > 1:
+        sys.exit(main(sys.argv[1:]))
 
     pc = PromConfig(url="http://localhost:9091/", disable_ssl=True)
     prom = PromConnect(pc)
@@ -44,7 +49,7 @@ if __name__ == "__main__":
         vc=vc,
         config=l
     )
-    result = v.validate()
+    result = asyncio.run(v.validate())
     e = ErrorResult(result)
     print(e.mae)
     print(e.mape)
@@ -0,0 +1,103 @@
+from validation import Validator, ValidationResult, ValidationQuery
+from output import RunningError
+from instrumentation import debug, logger
+from stresser import StresserError, retrieve_time_interval_from_log
+from datetime import datetime, timedelta
+from typing import NamedTuple, List
+import numpy as np
+import asyncio
+import time
+
+class OnlineConfig(NamedTuple):
+    # seconds between scoring polls while the stressor runs
+    poll_interval: float = 15
+    # newest seconds left out of each poll, prometheus may not have scraped them yet
+    ingest_lag: float = 10
+    # no abort decision is made before this many aligned samples
+    min_samples: int = 20
+    # abort once running mape is above this, 0 disables
+    mape_threshold: float = 0.0
+    # abort once the 95% confidence margin on mape is below this, 0 disables
+    settled_margin: float = 0.0
+
+class OnlineValidator(Validator):
+    # scores a validator while its stressor is still running, polling only the samples that
+    # arrived since the last poll, and stops the stressor early once the outcome is decided.
+    # the wrapped validator needs a Process based stress_process and a score_window method
+    def __init__(self, validator: Validator, oc: OnlineConfig):
+        self.validator = validator
+        self.stress_process = validator.stress_process
+        self.config = oc
+        self.running_error = RunningError()
+        self.aborted = False
+        self.abort_reason = ""
+
+    async def validate(self) -> ValidationResult:
+        self.running_error = RunningError()
+        self.aborted = False
+        self.abort_reason = ""
+        results: List[ValidationResult] = []
+
+        start_time = datetime.now()
+        target_popen = await self.stress_process.start()
+        tracker = self.stress_process.track(target_popen)
+        window_start = start_time
+        next_poll = time.monotonic() + self.config.poll_interval
+        try:
+            while target_popen.returncode is None:
+                if time.monotonic() >= next_poll:
+                    next_poll = time.monotonic() + self.config.poll_interval
+                    window_end = datetime.now() - timedelta(seconds=self.config.ingest_lag)
+                    if window_end > window_start:
+                        await self._score(window_start, window_end, tracker.pids, results)
+                        window_start = window_end + timedelta(seconds=1)
+                        self.abort_reason = self._abort_reason()
+                        if self.abort_reason:
+                            self.aborted = True
+                            logger.warning(f"online: stopping the stressor early, {self.abort_reason}")
+                            break
+                await asyncio.sleep(1)
+        finally:
+            # a failed poll or an early decision must not leave the stressor or the tracker running
+            try:
+                if target_popen.returncode is None:
+                    await self.stress_process.abort(target_popen)
+            finally:
+                all_child_pids = tracker.stop()
+
+        if not self.aborted:
+            if target_popen.returncode != 0:
+                raise StresserError(
+                    script_exit_code=target_popen.returncode,
+                    message="Status Code is non zero"
+                )
+            _, end_time = retrieve_time_interval_from_log(self.stress_process.time_range_log)
+            # the tail of the run only becomes queryable once prometheus has scraped it
+            await asyncio.sleep(self.config.ingest_lag)
+            if end_time and end_time > window_start:
+                await self._score(window_start, end_time, all_child_pids, results)
+
+        if not results:
+            return ValidationResult(vq=ValidationQuery(actual_query_name="", predicted_query_name=""), predicted=np.array([]), actual=np.array([]))
+        return ValidationResult(
+            vq=results[-1].vq,
+            predicted=np.concatenate([result.predicted for result in results]),
+            actual=np.concatenate([result.actual for result in results]),
+            timestamps=np.concatenate([result.timestamps for result in results]) if all(result.timestamps is not None for result in results) else None
+        )
+
+    async def _score(self, start: datetime, end: datetime, pids, results: List[ValidationResult]) -> None:
+        result = await self.validator.score_window(start, end, pids)
+        self.running_error.update(result.actual, result.predicted)
+        results.append(result)
+        debug("scored window", samples=self.running_error.count, mae=self.running_error.mae,
+              mape=self.running_error.mape, mape_margin=self.running_error.mape_margin)
+
+    def _abort_reason(self) -> str:
+        if self.running_error.count < self.config.min_samples:
+            return ""
+        if self.config.mape_threshold and self.running_error.mape > self.config.mape_threshold:
+            return f"mape {self.running_error.mape:.4%} is above the {self.config.mape_threshold:.4%} threshold"
+        if self.config.settled_margin and self.running_error.mape_margin < self.config.settled_margin:
+            return f"mape settled at {self.running_error.mape:.4%} +/- {self.running_error.mape_margin:.4%}"
+        return ""
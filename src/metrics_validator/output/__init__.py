@@ -1,18 +1,208 @@
-from sklearn.metrics import mean_absolute_error, mean_absolute_percentage_error
-import matplotlib.pyplot as plt
 from validation import ValidationResult
-from typing import List
+from instrumentation import span
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Dict, Iterable
+import numpy as np
+import hashlib
+import math
 import os
+import re
+
+# same epsilon floor on the mape denominator as sklearn's mean_absolute_percentage_error
+MAPE_EPSILON = np.finfo(np.float64).eps
+# absolute error percentiles reported by ErrorResult
+ERROR_PERCENTILES = (50, 90, 95, 99)
 
 # everything below should be output package
 class ErrorResult:
+    count: int
     mape: float
     mae: float
+    rmse: float
+    # mean of predicted - actual, positive when the prediction overestimates
+    bias: float
+    max_error: float
+    # absolute error at each of ERROR_PERCENTILES
+    percentiles: Dict[int, float]
+    # pearson correlation between predicted and actual
+    correlation: float
 
     def __init__(self, v: ValidationResult):
-        self.mape = mean_absolute_percentage_error(v.actual, v.predicted)
-        self.mae = mean_absolute_error(v.actual, v.predicted)
+        self.__dict__.update(_error_metrics([v])[0])
+
+    @classmethod
+    def batch(cls, results: Iterable[ValidationResult]) -> List["ErrorResult"]:
+        # every result is scored in the same vectorized pass over their concatenated samples
+        error_results = []
+        for metrics in _error_metrics(list(results)):
+            error_result = cls.__new__(cls)
+            error_result.__dict__.update(metrics)
+            error_results.append(error_result)
+        return error_results
+
+    @classmethod
+    def by_load(cls, v: ValidationResult) -> Dict[int, "ErrorResult"]:
+        # one ErrorResult per load level of a result scored by phase
+        if v.loads is None:
+            raise ValueError("result was not scored by phase, it has no load levels")
+        loads = np.asarray(v.loads)
+        levels = np.unique(loads).tolist()
+        masks = [loads == level for level in levels]
+        return dict(zip(levels, cls.batch(
+            ValidationResult(v.vq, np.asarray(v.predicted)[mask], np.asarray(v.actual)[mask]) for mask in masks
+        )))
+
+    def __str__(self) -> str:
+        percentiles = ", ".join(f"p{percentile} {value:.4f}" for percentile, value in self.percentiles.items())
+        return (f"samples {self.count}, mae {self.mae:.4f}, mape {self.mape:.4%}, rmse {self.rmse:.4f}, bias {self.bias:.4f}, "
+                f"max error {self.max_error:.4f}, {percentiles}, r {self.correlation:.4f}")
+
+def _error_metrics(results: List[ValidationResult]) -> List[dict]:
+    with span("error_metrics", results=len(results)) as metrics_span:
+        metrics = _segmented_metrics(results)
+        metrics_span.set(samples=sum(entry["count"] for entry in metrics))
+        return metrics
+
+def _segmented_metrics(results: List[ValidationResult]) -> List[dict]:
+    # results are laid end to end and each metric is a segmented reduction over the joined arrays
+    actual_parts = [np.asarray(result.actual, dtype=np.float64).ravel() for result in results]
+    predicted_parts = [np.asarray(result.predicted, dtype=np.float64).ravel() for result in results]
+    for actual, predicted in zip(actual_parts, predicted_parts):
+        if actual.shape != predicted.shape:
+            raise ValueError(f"actual and predicted differ in length: {actual.size} != {predicted.size}")
+    counts = np.array([actual.size for actual in actual_parts], dtype=np.int64)
+    metrics = [_empty_metrics() for _ in results]
+    filled = np.flatnonzero(counts)
+    if filled.size == 0:
+        return metrics
+
+    actual = np.concatenate([actual_parts[index] for index in filled])
+    predicted = np.concatenate([predicted_parts[index] for index in filled])
+    sizes = counts[filled]
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    segment = np.repeat(np.arange(filled.size), sizes)
+
+    error = predicted - actual
+    abs_error = np.abs(error)
+    mae = np.add.reduceat(abs_error, starts) / sizes
+    mape = np.add.reduceat(abs_error / np.maximum(np.abs(actual), MAPE_EPSILON), starts) / sizes
+    rmse = np.sqrt(np.add.reduceat(np.square(error), starts) / sizes)
+    bias = np.add.reduceat(error, starts) / sizes
+    max_error = np.maximum.reduceat(abs_error, starts)
+
+    # centered sums keep the correlation accurate for large, nearly constant series
+    actual_centered = actual - (np.add.reduceat(actual, starts) / sizes)[segment]
+    predicted_centered = predicted - (np.add.reduceat(predicted, starts) / sizes)[segment]
+    covariance = np.add.reduceat(actual_centered * predicted_centered, starts)
+    spread = np.sqrt(np.add.reduceat(np.square(actual_centered), starts) * np.add.reduceat(np.square(predicted_centered), starts))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = np.where(spread > 0, covariance / spread, np.nan)
+
+    # one sort of every segment's errors, percentiles are then read off with linear interpolation like np.percentile
+    sorted_error = abs_error[np.lexsort((abs_error, segment))]
+    percentiles = {}
+    for percentile in ERROR_PERCENTILES:
+        position = starts + (sizes - 1) * (percentile / 100)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, starts + sizes - 1)
+        fraction = position - lower
+        percentiles[percentile] = sorted_error[lower] * (1 - fraction) + sorted_error[upper] * fraction
+
+    for row, index in enumerate(filled):
+        metrics[index] = {
+            "count": int(sizes[row]),
+            "mae": float(mae[row]),
+            "mape": float(mape[row]),
+            "rmse": float(rmse[row]),
+            "bias": float(bias[row]),
+            "max_error": float(max_error[row]),
+            "percentiles": {percentile: float(values[row]) for percentile, values in percentiles.items()},
+            "correlation": float(correlation[row]),
+        }
+    return metrics
+
+def _empty_metrics() -> dict:
+    return {
+        "count": 0, "mae": math.nan, "mape": math.nan, "rmse": math.nan, "bias": math.nan, "max_error": math.nan,
+        "percentiles": {percentile: math.nan for percentile in ERROR_PERCENTILES}, "correlation": math.nan,
+    }
+
+
+class RunningError:
+    # mae and mape accumulated batch by batch, for scoring a run while it is still in progress
+    count: int
+    abs_error_sum: float
+    ape_sum: float
+    ape_square_sum: float
 
+    def __init__(self):
+        self.count = 0
+        self.abs_error_sum = 0.0
+        self.ape_sum = 0.0
+        self.ape_square_sum = 0.0
+
+    def update(self, actual: np.ndarray, predicted: np.ndarray) -> None:
+        actual = np.asarray(actual, dtype=np.float64)
+        predicted = np.asarray(predicted, dtype=np.float64)
+        abs_error = np.abs(actual - predicted)
+        ape = abs_error / np.maximum(np.abs(actual), MAPE_EPSILON)
+        self.count += abs_error.size
+        self.abs_error_sum += float(abs_error.sum())
+        self.ape_sum += float(ape.sum())
+        self.ape_square_sum += float(np.square(ape).sum())
+
+    @property
+    def mae(self) -> float:
+        return self.abs_error_sum / self.count if self.count else math.nan
+
+    @property
+    def mape(self) -> float:
+        return self.ape_sum / self.count if self.count else math.nan
+
+    @property
+    def mape_margin(self) -> float:
+        # half width of the 95% confidence interval around mape
+        if self.count < 2:
+            return math.inf
+        variance = max(self.ape_square_sum / self.count - self.mape ** 2, 0.0) * self.count / (self.count - 1)
+        return 1.96 * math.sqrt(variance / self.count)
+
+
+# longest series drawn as is, longer ones are reduced to this many points with lttb
+GRAPH_MAX_POINTS = 2000
+GRAPH_DPI = 150
+
+def lttb(values: np.ndarray, threshold: int) -> np.ndarray:
+    # largest triangle three buckets: indices of the points that best keep the shape of the series.
+    # the first and last points are always kept, every bucket in between contributes the point forming the
+    # largest triangle with the previously kept point and the average of the next bucket
+    values = np.asarray(values, dtype=np.float64)
+    size = values.size
+    if threshold < 3 or size <= threshold:
+        return np.arange(size)
+    positions = np.arange(size, dtype=np.float64)
+    edges = np.linspace(1, size - 1, threshold - 1).astype(np.int64)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = size - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = (edges[bucket + 1], edges[bucket + 2]) if bucket + 2 < edges.size else (size - 1, size)
+        average_position = positions[next_start:next_end].mean()
+        average_value = values[next_start:next_end].mean()
+        area = np.abs(
+            (positions[previous] - average_position) * (values[start:end] - values[previous])
+            - (positions[previous] - positions[start:end]) * (average_value - values[previous])
+        )
+        area[np.isnan(area)] = -1.0
+        previous = start + int(np.argmax(area))
+        kept[bucket + 1] = previous
+    return kept
+
+def _slug(name: str, limit: int = 60) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_")[:limit] or "result"
 
 class GraphedResult:
     save_path: str
@@ -20,25 +210,80 @@ class GraphedResult:
     actual: List[float]
     predicted_name: str
     actual_name: str
+    filename: str
     
-    def __init__(self, v: ValidationResult, save_path=""):
+    def __init__(self, v: ValidationResult, save_path="", filename="", max_points=GRAPH_MAX_POINTS, dpi=GRAPH_DPI):
         self.save_path = save_path
         self.predicted = v.predicted
         self.actual = v.actual
         self.predicted_name = v.vq.predicted_query_name
         self.actual_name = v.vq.actual_query_name
-    
-    def generate_graph(self, show_plt=False):
-        plt.plot(self.predicted, label=f"{self.predicted_name}", color="red")
-        plt.plot(self.actual, label=f"{self.actual_name}", color="blue")
-        plt.title("Baremetal Validation Result")
-        plt.xlabel("Datapoints")
-        plt.ylabel("CPU Time in seconds")
-        plt.legend()
-        expanded_save_path = os.path.expanduser(self.save_path)
-        filepath = os.path.join(expanded_save_path, "Baremtal_CPU_Time_Validation.png")
+        # derived from both query names and the time range scored unless given, so neither different validations
+        # nor reruns of the same one overwrite each other. results without timestamps are named by when they are graphed
+        digest = hashlib.sha1(f"{self.predicted_name}\n{self.actual_name}".encode()).hexdigest()[:10]
+        if v.timestamps is not None and len(v.timestamps):
+            time_range = f"{int(v.timestamps[0])}_{int(v.timestamps[-1])}"
+        else:
+            time_range = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        self.filename = filename or f"validation_{digest}_{time_range}.png"
+        self.max_points = max_points
+        self.dpi = dpi
+
+    def generate_graph(self, show_plt=False) -> str:
+        with span("plot", samples=len(self.actual)):
+            return self._generate_graph(show_plt)
+
+    def _generate_graph(self, show_plt: bool) -> str:
+        # drawn on its own figure through the agg canvas, so no global pyplot state is shared between graphs.
+        # pyplot is only involved when the graph is shown interactively
+        if show_plt:
+            import matplotlib.pyplot as plt
+            figure = plt.figure()
+        else:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            figure = Figure()
+            FigureCanvasAgg(figure)
+        axes = figure.add_subplot()
+        for samples, name, color in ((self.predicted, self.predicted_name, "red"), (self.actual, self.actual_name, "blue")):
+            kept = lttb(samples, self.max_points)
+            axes.plot(kept, np.asarray(samples)[kept], label=f"{name}", color=color)
+        axes.set_title("Baremetal Validation Result")
+        axes.set_xlabel("Datapoints")
+        axes.set_ylabel("CPU Time in seconds")
+        axes.legend()
+        filepath = ""
         if self.save_path:
-            plt.savefig(filepath, dpi=300, bbox_inches='tight')
+            expanded_save_path = os.path.expanduser(self.save_path)
+            filepath = os.path.join(expanded_save_path, self.filename)
+            figure.savefig(filepath, dpi=self.dpi, bbox_inches='tight')
 
         if show_plt:
-            plt.show()
\ No newline at end of file
+            plt.show()
+        return filepath
+
+def _render_graph(graphed_result: GraphedResult) -> str:
+    return graphed_result.generate_graph()
+
+def render_graphs(results: Iterable[ValidationResult], save_path: str, names: Iterable[str] = (), workers: int = 0,
+                  max_points: int = GRAPH_MAX_POINTS, dpi: int = GRAPH_DPI) -> List[str]:
+    # renders every result to its own png in a process pool, files are numbered in result order and named
+    # after names (or the predicted query) so a campaign's graphs never collide. returns the file paths
+    results = list(results)
+    names = list(names)
+    graphed_results = [
+        GraphedResult(
+            result, save_path,
+            filename=f"{index:04d}_{_slug(names[index] if index < len(names) else result.vq.predicted_query_name)}.png",
+            max_points=max_points, dpi=dpi
+        )
+        for index, result in enumerate(results)
+    ]
+    os.makedirs(os.path.expanduser(save_path), exist_ok=True)
+    workers = min(workers or os.cpu_count() or 1, len(graphed_results))
+    # graphs drawn in worker processes record their spans there, here the batch is timed as a whole
+    with span("render_graphs", graphs=len(graphed_results), workers=workers):
+        if workers <= 1:
+            return [_render_graph(graphed_result) for graphed_result in graphed_results]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_render_graph, graphed_results))
@@ -1,19 +1,27 @@
-from validation import QueryRange, ValidationConfig, Validator, ValidationResult, common_timestamps, keep_timestamps
-from prometheus import PromConnect
+from validation import ValidationConfig, Validator, ValidationResult, align, steady_windows, score_windows
+from prometheus import PromConnect, RangeRequest, PidRangeRequest
 from stresser import Process, Local
 import subprocess
 from datetime import datetime
-from typing import Iterable
+from typing import Iterable, Optional
+from utils import parse_cpu_list
+from instrumentation import debug, logger
 
 
 class NodeExporter(Validator):
-    def __init__(self, prom: PromConnect, vc: ValidationConfig): #rate_interval="20s", #prom_url="http://localhost:9090", isolated_cpu=15, stress_load=100, stresser_timeout=120):
+    def __init__(self, prom: PromConnect, vc: ValidationConfig, config: Optional[Local] = None): #rate_interval="20s", #prom_url="http://localhost:9090", isolated_cpu=15, stress_load=100, stresser_timeout=120):
         self.prom = prom
         self.validation_query = vc.vq
         self.rate_interval = vc.rate_interval
         self.isolated_cpus = vc.sc.isolated_cpus
+        self.join_mode = vc.join_mode
+        self.join_tolerance = vc.join_tolerance
+        self.step = vc.step
+        self.by_phase = vc.by_phase
+        self.phase_settle = vc.phase_settle
+        self.phase_loads = vc.phase_loads
         #self.stress_process = StressProcess(vc.sc)
-        l = Local(
+        l = config or Local(
             isolated_cpu="5",
             #load_curve="0:20,25:20,50:20,75:20,50:20,25:20,0:20",
             load_curve="0:20,25:30,50:30,75:30,100:30,75:30,50:30,25:30,0:20",
@@ -24,51 +32,47 @@ class NodeExporter(Validator):
         self.stress_process = Process(
             config=l
         )
+        # node exporter is read on the same cpus the stressor is pinned to
+        self.stressed_cpus = sorted(parse_cpu_list(l.isolated_cpu))
 
-    def validate(self) -> ValidationResult:
+    async def validate(self) -> ValidationResult:
         try: 
-            stress_output = self.stress_process.stress()
-            kepler_process_cpu_time = self._retrieve_kepler_process_cpu_time(stress_output.script_result.start_time, stress_output.script_result.end_time, stress_output.relevant_pids)
-            node_exporter_cpu_time = self._retrieve_node_cpu_time(stress_output.script_result.start_time, stress_output.script_result.end_time)
-            # logic makes sense to always sum it
-            common_timestamp_set = common_timestamps(kepler_process_cpu_time, node_exporter_cpu_time)
-            kepler_process_cpu_time = keep_timestamps(common_timestamp_set, kepler_process_cpu_time)
-            node_exporter_cpu_time = keep_timestamps(common_timestamp_set, node_exporter_cpu_time)
-            # aligned_kepler_process_cpu_time_datapoints = [DataPoint(datapoint.timestamp, datapoint.value) for datapoint in kepler_process_cpu_time.values if datapoint.timestamp in common_timestamp_set]
-            # aligned_kepler_process_cpu_time_datapoints.sort(key=lambda datapoint: datapoint.timestamp)
-            # kepler_process_cpu_time = QueryRange(kepler_process_cpu_time.query, aligned_kepler_process_cpu_time_datapoints)
-
-            # aligned_kepler_node_cpu_time_datapoints = [DataPoint(datapoint.timestamp, datapoint.value) for datapoint in node_exporter_cpu_time.values if datapoint.timestamp in common_timestamp_set]
-            # aligned_kepler_node_cpu_time_datapoints.sort(key=lambda datapoint: datapoint.timestamp)
-
-            # node_exporter_cpu_time = QueryRange(node_exporter_cpu_time.query, aligned_kepler_node_cpu_time_datapoints)
-            print(kepler_process_cpu_time.values)
-            print(node_exporter_cpu_time.values)
-            return ValidationResult(
-                vq=self.validation_query,
-                predicted=[datapoint.value for datapoint in kepler_process_cpu_time.values],
-                actual=[datapoint.value for datapoint in node_exporter_cpu_time.values]
-            )
+            stress_output = await self.stress_process.stress()
+            if self.by_phase:
+                windows = steady_windows(stress_output.script_result.phases, self.rate_interval, self.phase_settle, self.phase_loads)
+                return await score_windows(self.score_window, windows, stress_output.relevant_pids)
+            return await self.score_window(stress_output.script_result.start_time, stress_output.script_result.end_time, stress_output.relevant_pids)
         except subprocess.CalledProcessError as e:
-            print(f"Stress failed: {e}")
+            logger.error(f"Stress failed: {e}")
 
-    def _retrieve_kepler_process_cpu_time(self, start: datetime, end: datetime, target_pids: Iterable[int]) -> QueryRange:
-        pid_label = "|".join(map(str, target_pids))
-        query = f'sum(rate(kepler_process_bpf_cpu_time_ms_total{{pid=~"{pid_label}"}}[{self.rate_interval}]))'
-        print(query)
-        return self.prom.get_metric_range(
-            query=query,
-            start=start,
-            end=end
+    async def score_window(self, start: datetime, end: datetime, relevant_pids: Iterable[int]) -> ValidationResult:
+        kepler_process_cpu_time, node_exporter_cpu_time = await self.prom.get_metric_ranges([
+            self._kepler_process_cpu_time_request(relevant_pids, start, end),
+            RangeRequest(self._node_cpu_time_query(), start, end, self.step),
+        ])
+        # logic makes sense to always sum it
+        kepler_process_cpu_time, node_exporter_cpu_time = align(
+            kepler_process_cpu_time, node_exporter_cpu_time,
+            mode=self.join_mode,
+            tolerance=self.join_tolerance
         )
+        debug("aligned cpu time", samples=len(node_exporter_cpu_time),
+              kepler_total=float(kepler_process_cpu_time.samples.sum()), node_exporter_total=float(node_exporter_cpu_time.samples.sum()))
+        return ValidationResult(
+            vq=self.validation_query,
+            predicted=kepler_process_cpu_time.samples,
+            actual=node_exporter_cpu_time.samples,
+            timestamps=node_exporter_cpu_time.timestamps
+        )
+
+    def _kepler_process_cpu_time_request(self, target_pids: Iterable[int], start: datetime, end: datetime) -> PidRangeRequest:
+        request = PidRangeRequest('kepler_process_bpf_cpu_time_ms_total', target_pids, self.rate_interval, start, end, self.step)
+        debug("kepler cpu time query", query=request.query)
+        return request
 
-    def _retrieve_node_cpu_time(self, start: datetime, end: datetime) -> QueryRange:
+    def _node_cpu_time_query(self) -> str:
         #query = f'sum(rate(node_cpu_seconds_total{{cpu="{self.isolated_cpu}", mode!~"idle|system"}}[{self.rate_interval}])) * 1000'
-        cpu_label = "|".join(map(str, "5"))
+        cpu_label = "|".join(map(str, self.stressed_cpus))
         query = f'sum(rate(node_cpu_seconds_total{{cpu=~"{cpu_label}", mode!="idle"}}[{self.rate_interval}])) * 1000'
-        print(query)
-        return self.prom.get_metric_range(
-            query=query,
-            start=start,
-            end=end
-        )
\ No newline at end of file
+        debug("node exporter cpu time query", query=query)
+        return query
@@ -1,175 +1,163 @@
-from prometheus import PromConnect
-from stresser import Process, Local
-from validation import Validator, ValidationConfig, ValidationResult, ValidationQuery, QueryRange, DataPoint, common_timestamps, keep_timestamps
+from prometheus import PromConnect, RangeRequest, PidRangeRequest, CounterRequest, PID_REGEX_LIMIT
+from prometheus.plan import QueryPlan, Expr, Leaf, series, evaluate
+from prometheus.rate import CounterSeries, rate, sum_of, filter_series
+from stresser import Process, Local, StressProcess, ProcessOutput
+from validation import Validator, ValidationConfig, ValidationResult, ValidationQuery, QueryRange, align, steady_windows, score_windows
+from instrumentation import debug, logger
 from datetime import datetime
-from typing import Iterable
+from typing import Iterable, NamedTuple, List
 import subprocess
 
 class TurboStat(Validator):
     pass
 
+NODE_RAPL_PATH = "/host/sys/class/powercap/intel-rapl:0"
+
+class PowerCounters(NamedTuple):
+    # raw counters behind every series the power validation needs, fetched once per stress run
+    start: datetime
+    end: datetime
+    relevant_pids: Iterable[int]
+    cpu_time: List[CounterSeries]
+    process_package: List[CounterSeries]
+    node_rapl: List[CounterSeries]
+
 class NodeExporter(Validator):
     def __init__(self, prom: PromConnect, vc: ValidationConfig, config: Local):
         self.prom = prom
         self.validation_query = vc.vq
         self.rate_interval = vc.rate_interval
+        self.join_mode = vc.join_mode
+        self.join_tolerance = vc.join_tolerance
+        self.step = vc.step
+        self.local_rate = vc.local_rate
+        self.by_phase = vc.by_phase
+        self.phase_settle = vc.phase_settle
+        self.phase_loads = vc.phase_loads
+        self.verify = vc.verify
         self.stress_process = Process(
             config=config
         )
-    def validate(self) -> ValidationResult:
+
+    def __getstate__(self):
+        # evaluate_counters runs in worker processes, the prometheus connection stays in the parent
+        state = self.__dict__.copy()
+        state["prom"] = None
+        return state
+
+    async def validate(self) -> ValidationResult:
         try:
-            stress_output = self.stress_process.stress()
-            cpu_time_ratio = self._retrieve_target_cpu_time_ratio(stress_output.script_result.start_time, 
-                                                                             stress_output.script_result.end_time, 
-                                                                             stress_output.relevant_pids)
-            # cpu ratio time and multiply with total node exporter power
-            #power_ratio = self._retrieve_target_power_ratio(stress_output.start_time, stress_output.end_time, stress_output.child_pids)
-            total_node_rapl_power = self._retrieve_node_rapl_power(stress_output.script_result.start_time, stress_output.script_result.end_time)
-            process_rapl_power = self._retrieve_target_process_package_power(stress_output.script_result.start_time, stress_output.script_result.end_time, stress_output.relevant_pids)
-            print(len(total_node_rapl_power.values))
-            print(len(cpu_time_ratio.values))
-            print(len(process_rapl_power.values))
-            common_timestamp_set = common_timestamps(cpu_time_ratio, total_node_rapl_power)
-            cpu_time_ratio = keep_timestamps(common_timestamp_set, cpu_time_ratio)
-            node_rapl_power = keep_timestamps(common_timestamp_set, total_node_rapl_power)
-            process_kepler_power = keep_timestamps(common_timestamp_set, process_rapl_power)
-            expected_rapl_power = []
-            for ratio, node_power in zip(cpu_time_ratio.values, node_rapl_power.values):
-                timestamp = ratio.timestamp
-                process_power = ratio.value * node_power.value
-                expected_rapl_power.append(DataPoint(
-                    timestamp=timestamp,
-                    value = process_power
-                ))
-            print("TOTAL POWER RATIO")
-            pid_label = "|".join(map(str, stress_output.relevant_pids))
-            target_query = f'sum(rate(kepler_process_bpf_cpu_time_ms_total{{pid=~"{pid_label}"}}[{self.rate_interval}]))'
-            total_query = f'sum(rate(kepler_process_bpf_cpu_time_ms_total[{self.rate_interval}]))'
-            node_rapl_query = f'sum(rate(node_rapl_package_joules_total{{path="{"/host/sys/class/powercap/intel-rapl:0"}"}}[{self.rate_interval}]))'
-            test2 = self.prom.get_metric_range(
-                query=f"({target_query} / {total_query}) * {node_rapl_query}",
-                start=stress_output.script_result.start_time,
-                end=stress_output.script_result.end_time
-            )
-            for val1, val2 in zip(expected_rapl_power, test2.values):
-                print(val1.timestamp == val2.timestamp, val1.value == val2.value)
-            print("--------------------------------")
-            process_power_qr = QueryRange("expected package power process", expected_rapl_power)
-            new_vq = ValidationQuery(
-                actual_query_name=process_power_qr.query,
-                predicted_query_name=process_kepler_power.query
-            )
-            return ValidationResult(
-                vq=new_vq,
-                predicted=[datapoint.value for datapoint in process_kepler_power.values],
-                actual=[datapoint.value for datapoint in process_power_qr.values]
-            )
+            stress_output = await self.stress_process.stress()
+            score_window = self.score_window
+            if self.local_rate:
+                # raw counters are fetched once for the whole run, every window is evaluated locally from them
+                counters = await self.fetch_counters(stress_output, self.rate_interval)
+
+                async def score_window(start: datetime, end: datetime, relevant_pids: Iterable[int]) -> ValidationResult:
+                    return self.evaluate_counters(counters._replace(start=start, end=end), self.rate_interval, self.step)
+            if self.by_phase:
+                windows = steady_windows(stress_output.script_result.phases, self.rate_interval, self.phase_settle, self.phase_loads)
+                return await score_windows(score_window, windows, stress_output.relevant_pids)
+            return await score_window(stress_output.script_result.start_time, stress_output.script_result.end_time, stress_output.relevant_pids)
 
         except subprocess.CalledProcessError as e:
-            print(f"Stress failed: {e}")
-
-    def _retrieve_node_rapl_power(self, start: datetime, end:datetime) -> QueryRange:
-        query = f'sum(rate(node_rapl_package_joules_total{{path="{"/host/sys/class/powercap/intel-rapl:0"}"}}[{self.rate_interval}]))'
-        target_node_power = self.prom.get_metric_range(
-            query=query,
-            start=start,
-            end=end
-        )
-        return target_node_power
-    
-    def _retrieve_target_process_package_power(self, start: datetime, end: datetime, target_pids: Iterable[int]) -> QueryRange:
-        pid_label = "|".join(map(str, target_pids))
-        target_query = f'sum(rate(kepler_process_package_joules_total{{pid=~"{pid_label}"}}[{self.rate_interval}]))'
-        print(target_query)
-        target_power = self.prom.get_metric_range(
-            query=target_query,
-            start=start,
-            end=end
-        )
-        return target_power
-
-    # convert bottom methods into a single reusable one
-    def _retrieve_target_cpu_time_ratio(self, start: datetime, end: datetime, target_pids: Iterable[int]) -> QueryRange:
-        pid_label = "|".join(map(str, target_pids))
-        target_query = f'sum(rate(kepler_process_bpf_cpu_time_ms_total{{pid=~"{pid_label}"}}[{self.rate_interval}]))'
-        total_query = f'sum(rate(kepler_process_bpf_cpu_time_ms_total[{self.rate_interval}]))'
-        print(target_query)
-        print(total_query)
-        target_cpu_time = self.prom.get_metric_range(
-            query=target_query,
-            start=start,
-            end=end
+            logger.error(f"Stress failed: {e}")
+
+    async def score_window(self, start: datetime, end: datetime, relevant_pids: Iterable[int]) -> ValidationResult:
+        # the four leaf series are fetched once and the ratio and product are computed locally,
+        # with verify set the expected power is also evaluated by prometheus and compared
+        expected_power, process_kepler_power = self._power_expressions(
+            series(self._target_cpu_time_request(relevant_pids, start, end)),
+            series(RangeRequest(self._total_cpu_time_query(), start, end, self.step)),
+            series(RangeRequest(self._node_rapl_power_query(), start, end, self.step)),
+            series(self._target_process_package_power_request(relevant_pids, start, end)),
         )
-        total_cpu_time = self.prom.get_metric_range(
-            query=total_query,
+        plan = QueryPlan(self.prom, mode=self.join_mode, tolerance=self.join_tolerance, verify=self.verify)
+        return self._power_result(*await plan.evaluate(expected_power, process_kepler_power))
+
+    async def fetch_counters(self, stress_output: ProcessOutput, lookback: str) -> PowerCounters:
+        # lookback must cover the largest rate interval the counters will be evaluated at
+        start = stress_output.script_result.start_time
+        end = stress_output.script_result.end_time
+        relevant_pids = set(stress_output.relevant_pids)
+        # large pid sets do not fit a regex, every process is fetched instead and filtered locally
+        if len(relevant_pids) <= PID_REGEX_LIMIT:
+            pid_label = "|".join(map(str, sorted(relevant_pids)))
+            process_package_selector = f'kepler_process_package_joules_total{{pid=~"{pid_label}"}}'
+        else:
+            process_package_selector = 'kepler_process_package_joules_total'
+        cpu_time, process_package, node_rapl = await self.prom.get_counters([
+            # every process is needed for the total, the target pids are filtered out locally
+            CounterRequest('kepler_process_bpf_cpu_time_ms_total', start, end, lookback),
+            CounterRequest(process_package_selector, start, end, lookback),
+            CounterRequest(f'node_rapl_package_joules_total{{path="{NODE_RAPL_PATH}"}}', start, end, lookback),
+        ])
+        return PowerCounters(
             start=start,
-            end=end
+            end=end,
+            relevant_pids=stress_output.relevant_pids,
+            cpu_time=cpu_time,
+            process_package=process_package,
+            node_rapl=node_rapl
         )
 
-        test = self.prom.get_metric_range(
-            query=f"{target_query} / {total_query}",
-            start=start,
-            end=end
+    def evaluate_counters(self, counters: PowerCounters, rate_interval: str, step: str) -> ValidationResult:
+        # same series the server side queries produce, computed from the raw counters
+        pid_label = "|".join(map(str, counters.relevant_pids))
+        target_cpu_time = sum_of(rate, filter_series(counters.cpu_time, "pid", counters.relevant_pids),
+                                 self._target_cpu_time_query(pid_label, rate_interval), counters.start, counters.end, rate_interval, step)
+        total_cpu_time = sum_of(rate, counters.cpu_time,
+                                self._total_cpu_time_query(rate_interval), counters.start, counters.end, rate_interval, step)
+        node_rapl_power = sum_of(rate, counters.node_rapl,
+                                 self._node_rapl_power_query(rate_interval), counters.start, counters.end, rate_interval, step)
+        process_rapl_power = sum_of(rate, filter_series(counters.process_package, "pid", counters.relevant_pids),
+                                    self._target_process_package_power_query(pid_label, rate_interval), counters.start, counters.end, rate_interval, step)
+        # the same expressions as the server side path, evaluated over the locally computed leaves
+        ranges = [target_cpu_time, total_cpu_time, node_rapl_power, process_rapl_power]
+        leaves = [Leaf(RangeRequest(query_range.query, counters.start, counters.end, step)) for query_range in ranges]
+        expressions = self._power_expressions(*leaves)
+        return self._power_result(*evaluate(
+            list(expressions),
+            {leaf.key: query_range for leaf, query_range in zip(leaves, ranges)},
+            mode=self.join_mode,
+            tolerance=self.join_tolerance
+        ))
+
+    def _power_expressions(self, target_cpu_time: Expr, total_cpu_time: Expr, node_rapl_power: Expr, process_kepler_power: Expr):
+        # the process' share of cpu time multiplied with node rapl power is the power it is expected to draw
+        expected_power = (target_cpu_time / total_cpu_time * node_rapl_power).named("expected package power process")
+        return expected_power, process_kepler_power
+
+    def _power_result(self, process_power_qr: QueryRange, process_kepler_power: QueryRange) -> ValidationResult:
+        debug("power series", samples=len(process_power_qr))
+        new_vq = ValidationQuery(
+            actual_query_name=process_power_qr.query,
+            predicted_query_name=process_kepler_power.query
         )
-        print("OUR TEST VALS")
-        
-        for val in test.values:
-            print(val.timestamp, val.value)
-        print("-----------------")
-
-        # print("TOTAL POWER RATIO")
-        # node_rapl_query = f'sum(rate(node_rapl_package_joules_total{{path="{"/host/sys/class/powercap/intel-rapl:0"}"}}[{self.rate_interval}]))'
-        # test2 = self.prom.get_metric_range(
-        #     query=f"({target_query} / {total_query}) * {node_rapl_query}",
-        #     start=start,
-        #     end=end
-        # )
-        # for val1, val2 in zip(test.values, test2.values):
-        #     print(val1.timestamp == val2.timestamp, val1.value == val2.value)
-        # print("--------------------------------")
-
-        common_timestamps_set = common_timestamps(target_cpu_time, total_cpu_time)
-        target_cpu_time = keep_timestamps(common_timestamps_set, target_cpu_time)
-        total_cpu_time = keep_timestamps(common_timestamps_set, total_cpu_time)
-
-        ratio_datapoints = [DataPoint(datapoint.timestamp, datapoint.value / (total_cpu_time.values)[index].value) for index, datapoint in enumerate(target_cpu_time.values)]
-        ratio = QueryRange(
-            query=f"{target_cpu_time.query} / {total_cpu_time.query}",
-            values = ratio_datapoints
+        return ValidationResult(
+            vq=new_vq,
+            predicted=process_kepler_power.samples,
+            actual=process_power_qr.samples,
+            timestamps=process_power_qr.timestamps
         )
-        print("OUR ACTUAL VALS")
-        for val in ratio.values:
-            print(val.timestamp, val.value)
-        print("------------------------")
-
-        return ratio
-
-    # def _retrieve_target_power_ratio(self, start: datetime, end: datetime, target_pids: Iterable[int]) -> QueryRange:
-    #     pid_label = "|".join(map(str, target_pids))
-    #     target_query = f'sum(rate(kepler_process_package_joules_total{{pid=~"{pid_label}"}}[{self.rate_interval}]))'
-    #     total_query = f'sum(rate(kepler_process_package_joules_total[{self.rate_interval}]))'
-    #     print(target_query)
-    #     print(total_query)
-    #     target_power = self.prom.get_metric_range(
-    #         query=target_query,
-    #         start=start,
-    #         end=end
-    #     )
-    #     total_power = self.prom.get_metric_range(
-    #         query=total_query,
-    #         start=start,
-    #         end=end
-    #     )
-    #     common_timestamps_set = common_timestamps(target_power, total_power)
-    #     target_power = keep_timestamps(common_timestamps_set, target_power)
-    #     total_power = keep_timestamps(common_timestamps_set, total_power)
-
-    #     ratio_datapoints = [DataPoint(datapoint.timestamp, datapoint.value / (total_power.values)[index].value) for index, datapoint in enumerate(target_power.values)]
-    #     ratio = QueryRange(
-    #         query=f"{target_power.query} / {total_power.query}",
-    #         values = ratio_datapoints
-    #     )
-    #     return ratio
+
+    def _node_rapl_power_query(self, rate_interval: str = "") -> str:
+        return f'sum(rate(node_rapl_package_joules_total{{path="{NODE_RAPL_PATH}"}}[{rate_interval or self.rate_interval}]))'
+
+    def _target_process_package_power_request(self, pids: Iterable[int], start: datetime, end: datetime) -> PidRangeRequest:
+        return PidRangeRequest('kepler_process_package_joules_total', pids, self.rate_interval, start, end, self.step)
+
+    def _target_cpu_time_request(self, pids: Iterable[int], start: datetime, end: datetime) -> PidRangeRequest:
+        return PidRangeRequest('kepler_process_bpf_cpu_time_ms_total', pids, self.rate_interval, start, end, self.step)
+
+    def _target_process_package_power_query(self, pid_label: str, rate_interval: str = "") -> str:
+        return f'sum(rate(kepler_process_package_joules_total{{pid=~"{pid_label}"}}[{rate_interval or self.rate_interval}]))'
+
+    def _target_cpu_time_query(self, pid_label: str, rate_interval: str = "") -> str:
+        return f'sum(rate(kepler_process_bpf_cpu_time_ms_total{{pid=~"{pid_label}"}}[{rate_interval or self.rate_interval}]))'
+
+    def _total_cpu_time_query(self, rate_interval: str = "") -> str:
+        return f'sum(rate(kepler_process_bpf_cpu_time_ms_total[{rate_interval or self.rate_interval}]))'
 
 
 class Scaphandre(Validator):
@@ -177,44 +165,35 @@ class Scaphandre(Validator):
         self.prom = prom
         self.validation_query = vc.vq
         self.rate_interval = vc.rate_interval
+        self.join_mode = vc.join_mode
+        self.join_tolerance = vc.join_tolerance
+        self.step = vc.step
         self.stress_process = StressProcess(vc.sc)
 
-    def validate(self) -> ValidationResult:
+    async def validate(self) -> ValidationResult:
         try: 
-            stress_output = self.stress_process.stress()
-            kepler_process_power = self._retrieve_kepler(stress_output.start_time, 
-                                                                             stress_output.end_time, 
-                                                                             stress_output.child_pids)
-            scaph_process_power = self._retrieve_scaph(stress_output.start_time, stress_output.end_time, stress_output.child_pids)
-
-            common_timestamp_set = common_timestamps(kepler_process_power, scaph_process_power)
-            kepler_process_power = keep_timestamps(common_timestamp_set, kepler_process_power)
-            scaph_process_power = keep_timestamps(common_timestamp_set, scaph_process_power)
+            stress_output = await self.stress_process.stress()
+            kepler_process_power, scaph_process_power = await self.prom.get_metric_ranges([
+                PidRangeRequest('kepler_process_package_joules_total', stress_output.child_pids, self.rate_interval,
+                                stress_output.start_time, stress_output.end_time, self.step, scale=1000),
+                PidRangeRequest('scaph_process_power_consumption_microwatts', stress_output.child_pids, self.rate_interval,
+                                stress_output.start_time, stress_output.end_time, self.step),
+            ])
+
+            kepler_process_power, scaph_process_power = align(
+                kepler_process_power, scaph_process_power,
+                mode=self.join_mode,
+                tolerance=self.join_tolerance
+            )
 
             return ValidationResult(
-                predicted_query_name=kepler_process_power.query,
-                actual_query_name=scaph_process_power.query,
-                predicted=[datapoint.value for datapoint in kepler_process_power.values],
-                actual=[datapoint.value for datapoint in scaph_process_power.values]
+                vq=ValidationQuery(
+                    actual_query_name=scaph_process_power.query,
+                    predicted_query_name=kepler_process_power.query
+                ),
+                predicted=kepler_process_power.samples,
+                actual=scaph_process_power.samples,
+                timestamps=scaph_process_power.timestamps
             )
         except subprocess.CalledProcessError as e:
-            print(f"Stress failed: {e}")
-
-    def _retrieve_kepler(self, start: datetime, end: datetime, target_pids: Iterable[int]) -> QueryRange:
-        pid_label = "|".join(map(str, target_pids))
-        query = f'sum(rate(kepler_process_package_joules_total{{pid=~"{pid_label}"}}[{self.rate_interval}])) * 1000'
-        return self.prom.get_metric_range(
-            query=query,
-            start=start,
-            end=end
-        )
-
-    def _retrieve_scaph(self, start: datetime, end: datetime, target_pids: Iterable[int]) -> QueryRange:
-        pid_label = "|".join(map(str, target_pids))
-        #query = f'sum(rate(node_cpu_seconds_total{{cpu="{self.isolated_cpu}", mode!~"idle|system"}}[{self.rate_interval}])) * 1000'
-        query = f'sum(rate(scaph_process_power_consumption_microwatts{{pid=~"{pid_label}"}}[{self.rate_interval}]))'
-        return self.prom.get_metric_range(
-            query=query,
-            start=start,
-            end=end
-        )
\ No newline at end of file
+            logger.error(f"Stress failed: {e}")
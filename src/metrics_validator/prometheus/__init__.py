@@ -1,26 +1,337 @@
-from prometheus_api_client import PrometheusConnect
-from datetime import datetime
-from validation import QueryRange, DataPoint
-from typing import NamedTuple
+from datetime import datetime, timedelta
+from validation import QueryRange, sum_ranges
+from prometheus.cache import RangeCache
+from prometheus.rate import CounterSeries
+from utils import duration_to_seconds
+from instrumentation import span, logger
+from typing import NamedTuple, Iterable, List, Dict, Tuple, Union, Optional
+from itertools import chain
+import numpy as np
+import asyncio
+import json
+import math
+
+# orjson parses large matrix responses markedly faster, the standard library parser is the fallback
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# prometheus refuses range queries that would return more points than this per series
+MAX_POINTS_PER_SERIES = 11000
+
+# pid sets up to this size are selected with a single pid=~"a|b|c" regex
+PID_REGEX_LIMIT = 64
+# up to this size the regex is split into groups of PID_REGEX_LIMIT fetched concurrently and summed locally,
+# beyond it one sum by (pid) query is fetched and filtered locally
+PID_GROUPED_LIMIT = 1024
+PID_REGEX = "regex"
+PID_GROUPED = "grouped"
+PID_BY_LABEL = "by_label"
+
+# responses with these statuses are retried with exponential backoff
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+RETRY_ATTEMPTS = 3
+
+# prometheus gzips api responses when asked to, json matrices shrink several times. aiohttp inflates them on read
+QUERY_HEADERS = {"Accept-Encoding": "gzip"}
 
 class PromConfig(NamedTuple):
     url: str
     disable_ssl: bool
+    # upper bound on in-flight range queries, also used as the keep-alive pool size
+    max_concurrency: int = 6
+    # windows with more points than this are split into sub-windows, 0 disables chunking
+    max_points_per_query: int = MAX_POINTS_PER_SERIES
+    # directory for cached results of settled windows, empty disables the cache
+    cache_dir: str = ""
+    cache_max_bytes: int = 512 * 1024 * 1024
+
+class RangeRequest(NamedTuple):
+    query: str
+    start: datetime
+    end: datetime
+    step: str = "3s"
+
+class PidRangeRequest(NamedTuple):
+    # sum(rate(metric{pid=~...}[rate_interval])) * scale over an arbitrarily large pid set,
+    # PromConnect picks how the pids are selected from the size of the set
+    metric: str
+    pids: Iterable[int]
+    rate_interval: str
+    start: datetime
+    end: datetime
+    step: str = "3s"
+    scale: float = 1
+
+    @property
+    def query(self) -> str:
+        pid_label = "|".join(map(str, sorted(self.pids)))
+        return self._query(f'{{pid=~"{pid_label}"}}')
+
+    @property
+    def strategy(self) -> str:
+        pid_count = len(set(self.pids))
+        if pid_count <= PID_REGEX_LIMIT:
+            return PID_REGEX
+        if pid_count <= PID_GROUPED_LIMIT:
+            return PID_GROUPED
+        return PID_BY_LABEL
+
+    def _query(self, selector: str) -> str:
+        query = f'sum(rate({self.metric}{selector}[{self.rate_interval}]))'
+        return f"{query} * {self.scale:g}" if self.scale != 1 else query
+
+class LabeledRange(NamedTuple):
+    labels: Dict[str, str]
+    query_range: QueryRange
+
+class CounterRequest(NamedTuple):
+    selector: str
+    start: datetime
+    end: datetime
+    lookback: str
+
+class PrometheusError(Exception):
+    pass
 
 class PromConnect:
+    # every fetch is a coroutine, queries from any number of concurrent validations share one
+    # keep-alive connection pool and one bound on in-flight requests
     def __init__(self, pc: PromConfig) -> None:
-        self.prom = PrometheusConnect(url=pc.url, disable_ssl=pc.disable_ssl)
-
-    def get_metric_range(self, query: str, start: datetime, end: datetime) -> QueryRange:
-        series = self.prom.custom_query_range(
-            query=query,
-            start_time=start,
-            end_time=end,
-            step="3s"
-        )
-        values = series[0]['values']
-        datapoints = [DataPoint(int(value[0]), float(value[1])) for value in values]
-        return QueryRange(
-            query=query,
-            values=datapoints
-        )
\ No newline at end of file
+        self.url = pc.url.rstrip("/")
+        self.disable_ssl = pc.disable_ssl
+        self.max_concurrency = max(1, pc.max_concurrency)
+        self.max_points_per_query = min(pc.max_points_per_query, MAX_POINTS_PER_SERIES)
+        self.cache = RangeCache(pc.cache_dir, pc.cache_max_bytes, self.url) if pc.cache_dir else None
+        # created on first use inside the running event loop, see _client
+        self._session = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop = None
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def get_metric_range(self, query: str, start: datetime, end: datetime, step: str = "3s") -> QueryRange:
+        return (await self.get_metric_ranges([RangeRequest(query, start, end, step)]))[0]
+
+    async def get_metric_ranges(self, requests: Iterable[Union[RangeRequest, PidRangeRequest]]) -> List[QueryRange]:
+        # results are returned in the same order as requests, every request's sub-queries share one fetch batch
+        plans = [self._plan(request) for request in requests]
+        range_requests = [range_request for range_requests, _ in plans for range_request in range_requests]
+        series = await self.get_metric_range_series(range_requests)
+        query_ranges = []
+        offset = 0
+        for range_requests, combine in plans:
+            query_ranges.append(combine(series[offset:offset + len(range_requests)]))
+            offset += len(range_requests)
+        return query_ranges
+
+    async def get_metric_range_series(self, requests: Iterable[RangeRequest]) -> List[List[LabeledRange]]:
+        # every series each request returns, with its labels
+        requests = list(requests)
+        chunked_requests = [self._split_request(request) for request in requests]
+        sub_requests = [sub_request for chunks in chunked_requests for sub_request in chunks]
+        sub_series = [self._cached(sub_request) for sub_request in sub_requests]
+        # only cache misses go over the network
+        missing = [index for index, series in enumerate(sub_series) if series is None]
+        fetched = await asyncio.gather(*(self._query_range(*sub_requests[index]) for index in missing))
+        for index, series in zip(missing, fetched):
+            sub_series[index] = series
+            if self.cache:
+                self.cache.put(*sub_requests[index], series)
+
+        series = []
+        offset = 0
+        for request, chunks in zip(requests, chunked_requests):
+            series.append(stitch_series(request.query, sub_series[offset:offset + len(chunks)]))
+            offset += len(chunks)
+        return series
+
+    def _cached(self, request: RangeRequest) -> Optional[List[LabeledRange]]:
+        if not self.cache:
+            return None
+        cached = self.cache.get(*request)
+        return [LabeledRange(*entry) for entry in cached] if cached is not None else None
+
+    def _plan(self, request: Union[RangeRequest, PidRangeRequest]):
+        # the range requests to fetch for one request, and how to fold their series back into a single range
+        if isinstance(request, RangeRequest):
+            return [request], lambda series: _first_range(request.query, series[0])
+
+        query = request.query
+        strategy = request.strategy
+        if strategy == PID_REGEX:
+            return [RangeRequest(query, request.start, request.end, request.step)], lambda series: _first_range(query, series[0])
+
+        pids = sorted(set(map(str, request.pids)))
+        if strategy == PID_GROUPED:
+            groups = [pids[index:index + PID_REGEX_LIMIT] for index in range(0, len(pids), PID_REGEX_LIMIT)]
+            group_requests = [
+                RangeRequest(request._query(f'{{pid=~"{"|".join(group)}"}}'), request.start, request.end, request.step)
+                for group in groups
+            ]
+            return group_requests, lambda series: sum_ranges(query, [_first_range(query, group_series) for group_series in series])
+
+        # too many pids for any regex: one series per pid from the server, summed here over the wanted ones
+        wanted = set(pids)
+        by_label_query = f'sum by (pid) (rate({request.metric}[{request.rate_interval}]))'
+        if request.scale != 1:
+            by_label_query = f"{by_label_query} * {request.scale:g}"
+        by_label_request = RangeRequest(by_label_query, request.start, request.end, request.step)
+        return [by_label_request], lambda series: sum_ranges(query, [
+            labeled.query_range for labeled in series[0] if labeled.labels.get("pid") in wanted
+        ])
+
+    async def get_counters(self, requests: Iterable[CounterRequest]) -> List[List[CounterSeries]]:
+        # raw counter fetches share the same bounded pool as range queries, results keep request order
+        return list(await asyncio.gather(*(self.get_counter_series(*request) for request in requests)))
+
+    async def get_counter_series(self, selector: str, start: datetime, end: datetime, lookback: str) -> List[CounterSeries]:
+        # raw samples of every series matching selector, reaching lookback before start so
+        # rates over any interval up to lookback can be evaluated locally across [start, end]
+        window_seconds = math.ceil((end - start).total_seconds() + duration_to_seconds(lookback))
+        series = await self._api("query", {
+            "query": f"{selector}[{window_seconds}s]",
+            "time": end.timestamp()
+        })
+        return [
+            CounterSeries(labels=result['metric'], timestamps=timestamps, values=values)
+            for result, (timestamps, values) in zip(series, series_arrays(series))
+        ]
+
+    def _client(self):
+        # aiohttp sessions and semaphores belong to one event loop, a new loop gets its own pair.
+        # aiohttp is loaded on the first query so commands that never query start faster
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, ssl=False if self.disable_ssl else None)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._session, self._semaphore
+
+    async def _send(self, method: str, endpoint: str, read, **kwargs):
+        # one call to /api/v1/<endpoint>, retried on connection errors and retryable statuses. read consumes
+        # the successful response, returns its result and the number of attempts it took
+        import aiohttp
+        session, semaphore = self._client()
+        async with semaphore:
+            for attempt in range(RETRY_ATTEMPTS + 1):
+                try:
+                    async with session.request(method, f"{self.url}/api/v1/{endpoint}", **kwargs) as response:
+                        if response.status in RETRY_STATUSES and attempt < RETRY_ATTEMPTS:
+                            await asyncio.sleep(2 ** attempt)
+                            continue
+                        if response.status != 200:
+                            raise PrometheusError(f"HTTP Status Code {response.status} ({await response.text()})")
+                        return await read(response), attempt + 1
+                except aiohttp.ClientConnectionError:
+                    if attempt == RETRY_ATTEMPTS:
+                        raise
+                    await asyncio.sleep(2 ** attempt)
+
+    async def _api(self, endpoint: str, params: dict) -> list:
+        # GET /api/v1/<endpoint>, returning data.result. the span covers queueing on the semaphore and retries,
+        # and records the response size on the wire and inflated, and how many series and samples came back
+        async def read(response):
+            return await response.read(), response.headers.get("Content-Encoding", "identity"), response.content_length
+
+        with span(f"prometheus.{endpoint}", query=params["query"]) as query_span:
+            (raw, encoding, wire_bytes), attempts = await self._send("GET", endpoint, read, params=params, headers=QUERY_HEADERS)
+            body = json_loads(raw)
+            if body.get("status") != "success":
+                raise PrometheusError(f"{body.get('errorType')}: {body.get('error')}")
+            result = body["data"]["result"]
+            query_span.set(
+                attempts=attempts,
+                bytes=len(raw),
+                encoding=encoding,
+                wire_bytes=wire_bytes if wire_bytes is not None else len(raw),
+                series=len(result),
+                samples=sum(len(series["values"]) if "values" in series else 1 for series in result)
+            )
+            return result
+
+    def _split_request(self, request: RangeRequest) -> List[RangeRequest]:
+        if self.max_points_per_query <= 0:
+            return [request]
+        step_seconds = duration_to_seconds(request.step)
+        window_seconds = (request.end - request.start).total_seconds()
+        if window_seconds / step_seconds < self.max_points_per_query:
+            return [request]
+        # each sub-window holds max_points_per_query points and starts one step after the previous one ends
+        chunk_span = timedelta(seconds=step_seconds * (self.max_points_per_query - 1))
+        step = timedelta(seconds=step_seconds)
+        chunks = []
+        chunk_start = request.start
+        while chunk_start <= request.end:
+            chunk_end = min(chunk_start + chunk_span, request.end)
+            chunks.append(RangeRequest(request.query, chunk_start, chunk_end, request.step))
+            chunk_start = chunk_end + step
+        return chunks
+
+    async def _query_range(self, query: str, start: datetime, end: datetime, step: str) -> List[LabeledRange]:
+        series = await self._api("query_range", {
+            "query": query,
+            "start": start.timestamp(),
+            "end": end.timestamp(),
+            "step": step
+        })
+        # every series is kept with its labels, get_metric_range_series hands all of them out
+        return [
+            LabeledRange(labels=result['metric'], query_range=QueryRange.from_arrays(query, timestamps.astype(np.int64), samples))
+            for result, (timestamps, samples) in zip(series, series_arrays(series))
+        ]
+
+def series_arrays(result: List[dict]) -> List[Tuple[np.ndarray, np.ndarray]]:
+    # float64 timestamps and values of every series of a matrix result. the [timestamp, "value"] pairs of all series
+    # are flattened into one list and converted in two numpy calls, numpy parses the sample strings itself
+    # (NaN and +Inf included). each series gets views into the shared arrays
+    if not result:
+        return []
+    counts = [len(series["values"]) for series in result]
+    flat = list(chain.from_iterable(chain.from_iterable(series["values"] for series in result)))
+    timestamps = np.array(flat[0::2], dtype=np.float64)
+    values = np.array(flat[1::2], dtype=np.float64)
+    bounds = np.cumsum(counts)[:-1]
+    return list(zip(np.split(timestamps, bounds), np.split(values, bounds)))
+
+def _first_range(query: str, series: List[LabeledRange]) -> QueryRange:
+    # single series queries, an empty result becomes an empty range. a query that unexpectedly matches more
+    # series is reported instead of silently cut down, get_metric_range_series returns all of them
+    if not series:
+        return QueryRange(query=query)
+    if len(series) > 1:
+        logger.warning(f"{query}: {len(series)} series returned where one was expected, only the first is used. "
+                       f"aggregate the query or fetch it with get_metric_range_series")
+    return QueryRange.from_arrays(query, series[0].query_range.timestamps, series[0].query_range.samples)
+
+def stitch_series(query: str, chunks: List[List[LabeledRange]]) -> List[LabeledRange]:
+    # joins each series across time ordered sub-windows, series are matched by their label set
+    grouped: Dict[frozenset, List[LabeledRange]] = {}
+    for chunk in chunks:
+        for labeled in chunk:
+            grouped.setdefault(frozenset(labeled.labels.items()), []).append(labeled)
+    return [
+        LabeledRange(labeled[0].labels, stitch_ranges(query, [part.query_range for part in labeled]))
+        for labeled in grouped.values()
+    ]
+
+def stitch_ranges(query: str, query_ranges: List[QueryRange]) -> QueryRange:
+    # sub-windows arrive in time order, samples repeated on a shared boundary are dropped
+    if len(query_ranges) == 1:
+        return QueryRange.from_arrays(query, query_ranges[0].timestamps, query_ranges[0].samples)
+    timestamps = []
+    samples = []
+    last_timestamp = None
+    for query_range in query_ranges:
+        keep = query_range.timestamps > last_timestamp if last_timestamp is not None else slice(None)
+        timestamps.append(query_range.timestamps[keep])
+        samples.append(query_range.samples[keep])
+        if timestamps[-1].size:
+            last_timestamp = timestamps[-1][-1]
+    return QueryRange.from_arrays(query, np.concatenate(timestamps), np.concatenate(samples))
@@ -0,0 +1,92 @@
+from validation import QueryRange
+from datetime import datetime
+from utils import duration_to_seconds
+from typing import Optional, List, Tuple, Dict
+import numpy as np
+import threading
+import zipfile
+import hashlib
+import json
+import time
+import os
+
+# a window that ended this long ago is considered complete, late scrapes can no longer change it
+SETTLED_AFTER_SECONDS = 120
+
+class RangeCache:
+    # on-disk cache of range query results (every returned series with its labels), one .npz file per
+    # (prometheus url, query, start, end, step), evicted least recently used first once the directory grows past max_bytes
+    def __init__(self, cache_dir: str, max_bytes: int, url: str = ""):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        # servers sharing one cache directory never see each other's results
+        self.url = url.rstrip("/")
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, query: str, start: datetime, end: datetime, step: str) -> Optional[List[Tuple[Dict[str, str], QueryRange]]]:
+        path = self._path(query, start, end, step)
+        try:
+            with np.load(path) as cached:
+                timestamps = cached["timestamps"]
+                samples = cached["samples"]
+                offsets = cached["offsets"]
+                labels = json.loads(str(cached["labels"]))
+            # reads count as use for the lru order
+            os.utime(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        return [
+            (series_labels, QueryRange.from_arrays(query, timestamps[offsets[index]:offsets[index + 1]], samples[offsets[index]:offsets[index + 1]]))
+            for index, series_labels in enumerate(labels)
+        ]
+
+    def put(self, query: str, start: datetime, end: datetime, step: str, series: List[Tuple[Dict[str, str], QueryRange]]) -> None:
+        # only settled windows are immutable, anything reaching into the present may still change
+        if end.timestamp() > time.time() - SETTLED_AFTER_SECONDS:
+            return
+        path = self._path(query, start, end, step)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        # every series of the result is packed into two flat arrays, offsets mark where each one starts
+        offsets = np.zeros(len(series) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(query_range) for _, query_range in series])
+        with open(temp_path, "wb") as f:
+            np.savez(
+                f,
+                timestamps=np.concatenate([query_range.timestamps for _, query_range in series] or [np.array([], dtype=np.int64)]),
+                samples=np.concatenate([query_range.samples for _, query_range in series] or [np.array([], dtype=np.float64)]),
+                offsets=offsets,
+                labels=np.array(json.dumps([series_labels for series_labels, _ in series]))
+            )
+        os.replace(temp_path, path)
+        self._evict()
+
+    def _path(self, query: str, start: datetime, end: datetime, step: str) -> str:
+        # bounds exactly as sent to the query_range api, phase and online windows start at sub-second offsets and
+        # prometheus evaluates at start + k * step. only the step unit and query whitespace are normalized
+        normalized_query = " ".join(query.split())
+        key = f"{self.url}\n{normalized_query}\n{start.timestamp()!r}\n{end.timestamp()!r}\n{duration_to_seconds(step)}"
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".npz")
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries = []
+            total_bytes = 0
+            for entry in os.scandir(self.cache_dir):
+                if not entry.name.endswith(".npz"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
@@ -0,0 +1,407 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from prometheus.rate import CounterSeries, rate, irate, increase
+from utils import duration_to_seconds
+from typing import NamedTuple, List, Dict, Union, Optional
+import numpy as np
+import threading
+import json
+import gzip
+import time
+import re
+
+# a stand-in for prometheus serving deterministic synthetic kepler and node exporter series,
+# so the whole validate() pipeline can be benchmarked and profiled without hardware or a cluster
+
+FAKE_RAPL_PATH = "/host/sys/class/powercap/intel-rapl:0"
+# how far back an instant selector looks for its last sample, as in prometheus
+LOOKBACK_SECONDS = 300
+
+class SyntheticConfig(NamedTuple):
+    # number of kepler processes, pids run from 1 to pids
+    pids: int = 1000
+    duration: str = "1h"
+    scrape_interval: str = "3s"
+    # relative standard deviation of the noise on cpu usage and on kepler's power attribution
+    noise: float = 0.05
+    cpus: int = 16
+    idle_watts: float = 40.0
+    watts_per_cpu: float = 12.0
+    seed: int = 0
+    # unix time of the last sample, 0 ends the series at generation time
+    end: float = 0
+
+class Block(NamedTuple):
+    # every series of one metric, sharing the scrape timestamps
+    labels: List[Dict[str, str]]
+    values: np.ndarray
+
+class SyntheticKepler:
+    # counters are generated once up front: per-process cpu usage follows a shared load curve,
+    # node rapl follows the total, and kepler's per-process power is the cpu share of node power with noise on top
+    def __init__(self, sc: SyntheticConfig):
+        self.config = sc
+        rng = np.random.default_rng(sc.seed)
+        interval = duration_to_seconds(sc.scrape_interval)
+        samples = int(duration_to_seconds(sc.duration) // interval) + 1
+        end = sc.end or float(int(time.time() // interval) * interval)
+        self.timestamps = end - interval * np.arange(samples - 1, -1, -1, dtype=np.float64)
+        self.pids = list(range(1, sc.pids + 1))
+
+        # fraction of a cpu each process uses, scaled by a slow load curve shared by all processes
+        base_load = rng.uniform(0.0, 2.0 * sc.cpus / max(sc.pids, 1), size=(sc.pids, 1))
+        curve = 0.5 + 0.5 * np.sin(np.linspace(0, 4 * np.pi, samples))
+        usage = base_load * curve * (1 + sc.noise * rng.standard_normal((sc.pids, samples)))
+        np.clip(usage, 0.0, None, out=usage)
+        cpu_seconds = usage * interval
+        cpu_seconds[:, 0] = 0.0
+
+        # kepler process counters
+        cpu_time_ms = np.cumsum(cpu_seconds * 1000, axis=1)
+        busy_seconds = cpu_seconds.sum(axis=0)
+        node_joules_step = sc.idle_watts * interval + sc.watts_per_cpu * busy_seconds
+        with np.errstate(divide="ignore", invalid="ignore"):
+            share = np.where(busy_seconds > 0, cpu_seconds / busy_seconds, 0.0)
+        attribution = np.clip(1 + sc.noise * rng.standard_normal((sc.pids, samples)), 0.0, None)
+        package_joules = np.cumsum(share * node_joules_step * attribution, axis=1)
+        pid_labels = [{"pid": str(pid), "command": "stress-ng"} for pid in self.pids]
+
+        # node exporter counters, processes are spread round robin over the cpus
+        cpu_of_pid = np.arange(sc.pids) % sc.cpus
+        per_cpu_busy = np.zeros((sc.cpus, samples))
+        np.add.at(per_cpu_busy, cpu_of_pid, cpu_seconds)
+        per_cpu_idle = np.clip(interval - per_cpu_busy, 0.0, None)
+        per_cpu_idle[:, 0] = 0.0
+        node_cpu_rows = []
+        node_cpu_labels = []
+        for mode, seconds in (("user", per_cpu_busy * 0.9), ("system", per_cpu_busy * 0.1), ("idle", per_cpu_idle)):
+            node_cpu_rows.append(np.cumsum(seconds, axis=1))
+            node_cpu_labels += [{"cpu": str(cpu), "mode": mode} for cpu in range(sc.cpus)]
+
+        self.metrics: Dict[str, Block] = {
+            "kepler_process_bpf_cpu_time_ms_total": Block(pid_labels, cpu_time_ms),
+            "kepler_process_package_joules_total": Block(pid_labels, package_joules),
+            "node_cpu_seconds_total": Block(node_cpu_labels, np.vstack(node_cpu_rows)),
+            "node_rapl_package_joules_total": Block([{"path": FAKE_RAPL_PATH}], np.cumsum(node_joules_step)[np.newaxis, :]),
+        }
+
+    def pids_on_cpus(self, cpus) -> List[int]:
+        # the processes node_cpu_seconds_total attributes to the given cpus
+        cpus = set(map(int, cpus))
+        return [pid for pid in self.pids if (pid - 1) % self.config.cpus in cpus]
+
+    def select(self, name: str, matchers: List[tuple]) -> Block:
+        block = self.metrics.get(name)
+        if block is None:
+            return Block([], np.empty((0, self.timestamps.size)))
+        rows = [index for index, labels in enumerate(block.labels) if all(_matches(labels.get(label, ""), op, value) for label, op, value in matchers)]
+        return Block([dict(block.labels[index], __name__=name) for index in rows], block.values[rows])
+
+def _matches(actual: str, op: str, value: str) -> bool:
+    if op == "=":
+        return actual == value
+    if op == "!=":
+        return actual != value
+    # regex matchers are fully anchored, as in prometheus
+    matched = re.fullmatch(value, actual) is not None
+    return matched if op == "=~" else not matched
+
+# a small promql subset: selectors, rate/irate/increase over range selectors, sum [by (...)],
+# number literals and + - * / between vectors and scalars
+
+class PromQLError(Exception):
+    pass
+
+_TOKEN = re.compile(r'\s*(?:(?P<number>\d+(?:\.\d+)?(?:e[+-]?\d+)?)(?![a-zA-Z_])|(?P<duration>\[[^\]]+\])|(?P<string>"(?:[^"\\]|\\.)*")|(?P<op>=~|!~|!=|[-+*/(){},=])|(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*))')
+_FUNCTIONS = {"rate": rate, "irate": irate, "increase": increase}
+
+class Selector(NamedTuple):
+    name: str
+    matchers: List[tuple]
+    range_seconds: float
+
+class Call(NamedTuple):
+    function: str
+    selector: Selector
+
+class Sum(NamedTuple):
+    by: Optional[List[str]]
+    expr: object
+
+class Binary(NamedTuple):
+    op: str
+    left: object
+    right: object
+
+def _tokenize(query: str) -> List[tuple]:
+    tokens = []
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = _TOKEN.match(query, position)
+        if not match or match.end() == position:
+            raise PromQLError(f"unexpected character at {position} in: {query}")
+        position = match.end()
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+    return tokens
+
+class _Parser:
+    def __init__(self, query: str):
+        self.tokens = _tokenize(query)
+        self.position = 0
+
+    def parse(self):
+        expr = self._additive()
+        if self.position != len(self.tokens):
+            raise PromQLError(f"unexpected {self.tokens[self.position][1]}")
+        return expr
+
+    def _peek(self, value: Optional[str] = None):
+        if self.position >= len(self.tokens):
+            return None
+        token = self.tokens[self.position]
+        return token if value is None or token[1] == value else None
+
+    def _take(self, value: Optional[str] = None) -> tuple:
+        token = self._peek()
+        if token is None or (value is not None and token[1] != value):
+            raise PromQLError(f"expected {value or 'a token'}, got {token[1] if token else 'end of query'}")
+        self.position += 1
+        return token
+
+    def _additive(self):
+        expr = self._multiplicative()
+        while self._peek("+") or self._peek("-"):
+            op = self._take()[1]
+            expr = Binary(op, expr, self._multiplicative())
+        return expr
+
+    def _multiplicative(self):
+        expr = self._unary()
+        while self._peek("*") or self._peek("/"):
+            op = self._take()[1]
+            expr = Binary(op, expr, self._unary())
+        return expr
+
+    def _unary(self):
+        kind, value = self._take()
+        if kind == "number":
+            return float(value)
+        if value == "(":
+            expr = self._additive()
+            self._take(")")
+            return expr
+        if kind != "name":
+            raise PromQLError(f"unexpected {value}")
+        if value == "sum":
+            by = self._by()
+            self._take("(")
+            expr = self._additive()
+            self._take(")")
+            return Sum(by if by is not None else self._by(), expr)
+        if value in _FUNCTIONS:
+            self._take("(")
+            selector = self._selector(self._take()[1])
+            self._take(")")
+            if not selector.range_seconds:
+                raise PromQLError(f"{value} needs a range selector")
+            return Call(value, selector)
+        return self._selector(value)
+
+    def _by(self) -> Optional[List[str]]:
+        if not self._peek("by"):
+            return None
+        self._take("by")
+        self._take("(")
+        labels = []
+        while not self._peek(")"):
+            labels.append(self._take()[1])
+            if self._peek(","):
+                self._take(",")
+        self._take(")")
+        return labels
+
+    def _selector(self, name: str) -> Selector:
+        matchers = []
+        if self._peek("{"):
+            self._take("{")
+            while not self._peek("}"):
+                label = self._take()[1]
+                op = self._take()[1]
+                kind, value = self._take()
+                if kind != "string":
+                    raise PromQLError(f"expected a quoted label value for {label}")
+                matchers.append((label, op, json.loads(value)))
+                if self._peek(","):
+                    self._take(",")
+            self._take("}")
+        range_seconds = 0.0
+        token = self._peek()
+        if token and token[0] == "duration":
+            range_seconds = duration_to_seconds(self._take()[1][1:-1])
+        return Selector(name, matchers, range_seconds)
+
+def parse(query: str):
+    return _Parser(query).parse()
+
+Value = Union[float, Block]
+
+def evaluate(expr, kepler: SyntheticKepler, eval_timestamps: np.ndarray) -> Value:
+    # every node evaluates to a scalar or a block of series over eval_timestamps, nan where a series has no value
+    if isinstance(expr, float):
+        return expr
+    if isinstance(expr, Selector):
+        if expr.range_seconds:
+            raise PromQLError("range selectors are only supported inside functions or as a whole instant query")
+        block = kepler.select(expr.name, expr.matchers)
+        positions = np.searchsorted(kepler.timestamps, eval_timestamps, side="right") - 1
+        fresh = (positions >= 0) & (eval_timestamps - kepler.timestamps[np.clip(positions, 0, None)] <= LOOKBACK_SECONDS)
+        values = block.values[:, np.clip(positions, 0, None)]
+        values[:, ~fresh] = np.nan
+        return Block(block.labels, values)
+    if isinstance(expr, Call):
+        block = kepler.select(expr.selector.name, expr.selector.matchers)
+        labels = [_without_name(labels) for labels in block.labels]
+        if not labels:
+            return Block([], np.empty((0, eval_timestamps.size)))
+        values = _FUNCTIONS[expr.function](CounterSeries({}, kepler.timestamps, block.values), eval_timestamps, expr.selector.range_seconds)
+        return Block(labels, values)
+    if isinstance(expr, Sum):
+        return _sum(evaluate(expr.expr, kepler, eval_timestamps), expr.by or [], eval_timestamps.size)
+    if isinstance(expr, Binary):
+        return _binary(expr.op, evaluate(expr.left, kepler, eval_timestamps), evaluate(expr.right, kepler, eval_timestamps))
+    raise PromQLError(f"cannot evaluate {expr}")
+
+def _without_name(labels: Dict[str, str]) -> Dict[str, str]:
+    return {label: value for label, value in labels.items() if label != "__name__"}
+
+def _sum(block: Value, by: List[str], width: int) -> Block:
+    if isinstance(block, float):
+        raise PromQLError("sum needs a vector")
+    groups: Dict[tuple, int] = {}
+    group_of_row = np.array([groups.setdefault(tuple(labels.get(label, "") for label in by), len(groups)) for labels in block.labels], dtype=np.int64)
+    totals = np.zeros((len(groups), width))
+    present = np.zeros((len(groups), width), dtype=bool)
+    if len(groups):
+        np.add.at(totals, group_of_row, np.nan_to_num(block.values))
+        np.logical_or.at(present, group_of_row, ~np.isnan(block.values))
+    totals[~present] = np.nan
+    return Block([{label: value for label, value in zip(by, key) if value} for key in groups], totals)
+
+_OPERATORS = {"+": np.add, "-": np.subtract, "*": np.multiply, "/": np.divide}
+
+def _binary(op: str, left: Value, right: Value) -> Value:
+    function = _OPERATORS[op]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if isinstance(left, float) and isinstance(right, float):
+            return float(function(left, right))
+        if isinstance(left, float):
+            return Block([_without_name(labels) for labels in right.labels], function(left, right.values))
+        if isinstance(right, float):
+            return Block([_without_name(labels) for labels in left.labels], function(left.values, right))
+        # one to one matching on identical label sets
+        right_rows = {frozenset(_without_name(labels).items()): index for index, labels in enumerate(right.labels)}
+        pairs = [(index, right_rows.get(frozenset(_without_name(labels).items()))) for index, labels in enumerate(left.labels)]
+        pairs = [(left_index, right_index) for left_index, right_index in pairs if right_index is not None]
+        return Block(
+            [_without_name(left.labels[left_index]) for left_index, _ in pairs],
+            function(left.values[[left_index for left_index, _ in pairs]], right.values[[right_index for _, right_index in pairs]])
+        )
+
+def query_range(kepler: SyntheticKepler, query: str, start: float, end: float, step: float) -> List[dict]:
+    eval_timestamps = start + step * np.arange(int((end - start) // step) + 1)
+    result = evaluate(parse(query), kepler, eval_timestamps)
+    if isinstance(result, float):
+        result = Block([{}], np.full((1, eval_timestamps.size), result))
+    # serialization dominates large responses, so rows without gaps skip the per-row masking
+    timestamps = eval_timestamps.tolist()
+    missing = np.isnan(result.values)
+    series = []
+    for labels, row, row_missing in zip(result.labels, result.values, missing):
+        if not row_missing.any():
+            series.append({"metric": labels, "values": [[timestamp, repr(value)] for timestamp, value in zip(timestamps, row.tolist())]})
+        elif not row_missing.all():
+            present = ~row_missing
+            series.append({"metric": labels, "values": [[timestamp, repr(value)] for timestamp, value in zip(eval_timestamps[present].tolist(), row[present].tolist())]})
+    return series
+
+def query_instant(kepler: SyntheticKepler, query: str, at: float) -> dict:
+    expr = parse(query)
+    # a bare range selector returns the raw samples, as get_counter_series requests them
+    if isinstance(expr, Selector) and expr.range_seconds:
+        block = kepler.select(expr.name, expr.matchers)
+        window = (kepler.timestamps > at - expr.range_seconds) & (kepler.timestamps <= at)
+        timestamps = kepler.timestamps[window].tolist()
+        return {"resultType": "matrix", "result": [
+            {"metric": labels, "values": [[timestamp, repr(value)] for timestamp, value in zip(timestamps, row[window].tolist())]}
+            for labels, row in zip(block.labels, block.values)
+        ]}
+    series = query_range(kepler, query, at, at, 1.0)
+    return {"resultType": "vector", "result": [{"metric": entry["metric"], "value": entry["values"][0]} for entry in series]}
+
+class _Handler(BaseHTTPRequestHandler):
+    kepler: SyntheticKepler = None
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self._respond(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        params = parse_qs(urlparse(self.path).query)
+        params.update(parse_qs(body))
+        self._respond(params)
+
+    def _respond(self, params: Dict[str, List[str]]) -> None:
+        path = urlparse(self.path).path.rstrip("/")
+        try:
+            query = params["query"][0]
+            if path == "/api/v1/query_range":
+                data = {"resultType": "matrix", "result": query_range(
+                    self.kepler, query, float(params["start"][0]), float(params["end"][0]), duration_to_seconds(params["step"][0])
+                )}
+            elif path == "/api/v1/query":
+                data = query_instant(self.kepler, query, float(params["time"][0]) if "time" in params else float(self.kepler.timestamps[-1]))
+            else:
+                self._send(404, {"status": "error", "errorType": "not_found", "error": f"unknown endpoint {path}"})
+                return
+        except (PromQLError, KeyError, ValueError) as e:
+            self._send(400, {"status": "error", "errorType": "bad_data", "error": str(e)})
+            return
+        self._send(200, {"status": "success", "data": data})
+
+    def _send(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        # gzipped on request, as prometheus does
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakePrometheus:
+    # serves /api/v1/query_range and /api/v1/query for a SyntheticKepler on a background thread,
+    # point PromConfig.url at .url
+    def __init__(self, kepler: SyntheticKepler, host: str = "127.0.0.1", port: int = 0):
+        handler = type("Handler", (_Handler,), {"kepler": kepler})
+        self.kepler = kepler
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "FakePrometheus":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
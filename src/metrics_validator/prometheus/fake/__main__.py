@@ -0,0 +1,36 @@
+from prometheus.fake import SyntheticConfig, SyntheticKepler, FakePrometheus
+import argparse
+import time
+
+# python -m prometheus.fake --pids 5000 --duration 6h --port 9091
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve synthetic kepler series on a local prometheus api")
+    parser.add_argument("--pids", type=int, default=SyntheticConfig.pids)
+    parser.add_argument("--duration", default=SyntheticConfig.duration)
+    parser.add_argument("--scrape-interval", default=SyntheticConfig.scrape_interval)
+    parser.add_argument("--noise", type=float, default=SyntheticConfig.noise)
+    parser.add_argument("--cpus", type=int, default=SyntheticConfig.cpus)
+    parser.add_argument("--seed", type=int, default=SyntheticConfig.seed)
+    parser.add_argument("--end", type=float, default=SyntheticConfig.end)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9091)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    kepler = SyntheticKepler(SyntheticConfig(
+        pids=args.pids,
+        duration=args.duration,
+        scrape_interval=args.scrape_interval,
+        noise=args.noise,
+        cpus=args.cpus,
+        seed=args.seed,
+        end=args.end
+    ))
+    fake = FakePrometheus(kepler, args.host, args.port).start()
+    print(f"generated {args.pids} pids over {args.duration} in {time.perf_counter() - started:.2f}s")
+    print(f"serving {fake.url}, series from {kepler.timestamps[0]:.0f} to {kepler.timestamps[-1]:.0f}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
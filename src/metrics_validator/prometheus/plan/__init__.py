@@ -0,0 +1,185 @@
+from prometheus import PromConnect, RangeRequest, PidRangeRequest, PID_REGEX
+from validation import QueryRange, align, EXACT_JOIN
+from instrumentation import span, debug, logger
+from datetime import datetime
+from abc import ABC, abstractmethod
+from typing import NamedTuple, List, Dict, Iterator, Tuple, Union
+import numpy as np
+import copy
+
+# validators declare the series they need as expressions over leaf requests, e.g.
+#
+#   expected = series(target_cpu_time) / series(total_cpu_time) * series(node_rapl_power)
+#
+# a plan fetches every distinct leaf of all its expressions once per window, lines the leaves up and does the
+# arithmetic locally. the server side rendering of an expression is only fetched in verification mode, where it
+# cross checks the local arithmetic against prometheus
+
+# relative difference between the local and the server side evaluation still counted as a match
+VERIFY_TOLERANCE = 1e-9
+
+LeafKey = Tuple[str, datetime, datetime, str]
+
+class Expr(ABC):
+    name: str
+
+    def __truediv__(self, other: "Expr") -> "Binary":
+        return Binary("/", self, other)
+
+    def __mul__(self, other: "Expr") -> "Binary":
+        return Binary("*", self, other)
+
+    def named(self, name: str) -> "Expr":
+        # the query name of the evaluated range, the promql text otherwise
+        named = copy.copy(self)
+        named.name = name
+        return named
+
+    @property
+    @abstractmethod
+    def promql(self) -> str:
+        pass
+
+    @property
+    @abstractmethod
+    def server_side(self) -> bool:
+        # whether prometheus can evaluate the whole expression as one query
+        pass
+
+    @abstractmethod
+    def leaves(self) -> Iterator["Leaf"]:
+        pass
+
+    @abstractmethod
+    def evaluate(self, columns: Dict[LeafKey, np.ndarray]) -> np.ndarray:
+        pass
+
+class Leaf(Expr):
+    def __init__(self, request: Union[RangeRequest, PidRangeRequest]):
+        self.request = request
+        self.name = ""
+        # requests for the same query text over the same window are fetched once
+        self.key: LeafKey = (request.query, request.start, request.end, request.step)
+
+    @property
+    def promql(self) -> str:
+        return self.request.query
+
+    @property
+    def server_side(self) -> bool:
+        # grouped and by label pid requests are summed locally, their query text would not fit a request
+        return isinstance(self.request, RangeRequest) or self.request.strategy == PID_REGEX
+
+    def leaves(self) -> Iterator["Leaf"]:
+        yield self
+
+    def evaluate(self, columns: Dict[LeafKey, np.ndarray]) -> np.ndarray:
+        return columns[self.key]
+
+class Binary(Expr):
+    def __init__(self, op: str, left: Expr, right: Expr):
+        self.op = op
+        self.left = left
+        self.right = right
+        self.name = ""
+
+    @property
+    def promql(self) -> str:
+        return f"{_operand(self.left)} {self.op} {_operand(self.right)}"
+
+    @property
+    def server_side(self) -> bool:
+        return self.left.server_side and self.right.server_side
+
+    def leaves(self) -> Iterator[Leaf]:
+        yield from self.left.leaves()
+        yield from self.right.leaves()
+
+    def evaluate(self, columns: Dict[LeafKey, np.ndarray]) -> np.ndarray:
+        left = self.left.evaluate(columns)
+        right = self.right.evaluate(columns)
+        # like promql, division by zero yields inf or nan rather than raising
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return left / right if self.op == "/" else left * right
+
+def _operand(expr: Expr) -> str:
+    return f"({expr.promql})" if isinstance(expr, Binary) else expr.promql
+
+def series(request: Union[RangeRequest, PidRangeRequest]) -> Leaf:
+    return Leaf(request)
+
+def unique_leaves(exprs: List[Expr]) -> List[Leaf]:
+    # first occurrence of every distinct leaf, in declaration order
+    leaves: Dict[LeafKey, Leaf] = {}
+    for expr in exprs:
+        for leaf in expr.leaves():
+            leaves.setdefault(leaf.key, leaf)
+    return list(leaves.values())
+
+def evaluate(exprs: List[Expr], ranges: Dict[LeafKey, QueryRange], mode: str = EXACT_JOIN, tolerance: int = 0) -> List[QueryRange]:
+    # every leaf is lined up in one pass, so all expressions see the same timestamps
+    leaves = unique_leaves(exprs)
+    aligned = align(*(ranges[leaf.key] for leaf in leaves), mode=mode, tolerance=tolerance)
+    columns = {leaf.key: query_range.samples for leaf, query_range in zip(leaves, aligned)}
+    timestamps = aligned[0].timestamps if aligned else np.empty(0, dtype=np.int64)
+    return [QueryRange.from_arrays(expr.name or expr.promql, timestamps, expr.evaluate(columns)) for expr in exprs]
+
+class Verification(NamedTuple):
+    query: str
+    samples: int
+    mismatches: int
+    max_relative_error: float
+
+class QueryPlan:
+    def __init__(self, prom: PromConnect, mode: str = EXACT_JOIN, tolerance: int = 0, verify: bool = False):
+        self.prom = prom
+        self.mode = mode
+        self.tolerance = tolerance
+        self.verify = verify
+        self.verifications: List[Verification] = []
+
+    async def evaluate(self, *exprs: Expr) -> List[QueryRange]:
+        leaves = unique_leaves(list(exprs))
+        with span("query_plan", expressions=len(exprs), leaves=len(leaves)):
+            fetched = await self.prom.get_metric_ranges([leaf.request for leaf in leaves])
+            results = evaluate(list(exprs), {leaf.key: query_range for leaf, query_range in zip(leaves, fetched)}, self.mode, self.tolerance)
+            if self.verify:
+                await self._verify(list(exprs), results)
+        return results
+
+    async def _verify(self, exprs: List[Expr], results: List[QueryRange]) -> None:
+        # only composite expressions prometheus can evaluate as a whole are worth a second query
+        checked = [(expr, result) for expr, result in zip(exprs, results) if isinstance(expr, Binary) and expr.server_side]
+        if not checked:
+            debug("nothing to verify on the server", expressions=len(exprs))
+            return
+        with span("query_plan.verify", expressions=len(checked)):
+            requests = []
+            for expr, _ in checked:
+                window = next(expr.leaves()).request
+                requests.append(RangeRequest(expr.promql, window.start, window.end, window.step))
+            server_ranges = await self.prom.get_metric_ranges(requests)
+            for (expr, local), server in zip(checked, server_ranges):
+                verification = _compare(expr.name or expr.promql, local, server)
+                self.verifications.append(verification)
+                debug("verified", **verification._asdict())
+                if verification.mismatches:
+                    logger.warning(f"{verification.query}: {verification.mismatches} of {verification.samples} samples differ "
+                                   f"from the server side evaluation, up to {verification.max_relative_error:.3g} relative")
+
+def _compare(query: str, local: QueryRange, server: QueryRange, tolerance: float = VERIFY_TOLERANCE) -> Verification:
+    local, server = align(local, server)
+    if len(local) == 0:
+        return Verification(query, 0, 0, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative_error = np.abs(local.samples - server.samples) / np.maximum(np.abs(server.samples), np.finfo(np.float64).eps)
+    # equal values (infinities included) and nan on both sides match, nan on one side does not
+    same = (local.samples == server.samples) | (np.isnan(local.samples) & np.isnan(server.samples))
+    relative_error[same] = 0.0
+    relative_error[np.isnan(relative_error)] = np.inf
+    return Verification(
+        query=query,
+        samples=len(local),
+        mismatches=int(np.count_nonzero(relative_error > tolerance)),
+        max_relative_error=float(relative_error.max())
+    )
@@ -0,0 +1,111 @@
+from validation import QueryRange
+from datetime import datetime
+from utils import duration_to_seconds
+from typing import NamedTuple, Dict, List, Callable, Iterable
+import numpy as np
+
+# client-side versions of promql rate(), irate() and increase() over raw counter samples,
+# so a series fetched once can be re-evaluated at any rate interval without another query
+
+class CounterSeries(NamedTuple):
+    labels: Dict[str, str]
+    # float64 seconds with millisecond precision, as scraped
+    timestamps: np.ndarray
+    # one value per timestamp, or a 2-d block with one row per series when many series share the timestamps
+    values: np.ndarray
+
+def evaluation_timestamps(start: datetime, end: datetime, step: str) -> np.ndarray:
+    # the same grid a query_range request evaluates on: prometheus keeps the bounds as sent, to the millisecond,
+    # and steps from the exact start while at or before end. phase windows start at fractional seconds
+    start_ms = round(start.timestamp() * 1000)
+    end_ms = round(end.timestamp() * 1000)
+    step_ms = round(duration_to_seconds(step) * 1000)
+    return np.arange(start_ms, end_ms + 1, step_ms) / 1000.0
+
+def _reset_corrected(values: np.ndarray) -> np.ndarray:
+    # a counter that drops has restarted from zero, carry the value it had reached forward
+    corrections = np.zeros(values.shape, dtype=np.float64)
+    if values.shape[-1] > 1:
+        drops = values[..., 1:] < values[..., :-1]
+        corrections[..., 1:] = np.cumsum(np.where(drops, values[..., :-1], 0.0), axis=-1)
+    return values + corrections
+
+def _window_bounds(series: CounterSeries, eval_timestamps: np.ndarray, range_seconds: float):
+    # samples in the left-open window (t - range, t], as index range [lower, upper)
+    lower = np.searchsorted(series.timestamps, eval_timestamps - range_seconds, side="right")
+    upper = np.searchsorted(series.timestamps, eval_timestamps, side="right")
+    return lower, upper
+
+def _extrapolated_delta(series: CounterSeries, eval_timestamps: np.ndarray, range_seconds: float, is_rate: bool) -> np.ndarray:
+    # mirrors extrapolatedRate in promql/functions.go, nan where the window holds fewer than two samples
+    eval_timestamps = np.asarray(eval_timestamps, dtype=np.float64)
+    result = np.full(series.values.shape[:-1] + eval_timestamps.shape, np.nan)
+    lower, upper = _window_bounds(series, eval_timestamps, range_seconds)
+    valid = upper - lower >= 2
+    if not np.any(valid):
+        return result
+    first = lower[valid]
+    last = upper[valid] - 1
+    corrected = _reset_corrected(series.values)
+    delta = corrected[..., last] - corrected[..., first]
+    first_t = series.timestamps[first]
+    last_t = series.timestamps[last]
+    range_end = eval_timestamps[valid]
+    range_start = range_end - range_seconds
+
+    duration_to_start = first_t - range_start
+    duration_to_end = range_end - last_t
+    sampled_interval = last_t - first_t
+    average_interval = sampled_interval / (last - first)
+    threshold = average_interval * 1.1
+    duration_to_start = np.where(duration_to_start >= threshold, average_interval / 2, duration_to_start)
+    # a counter cannot extrapolate back past the point where it would have been zero
+    first_values = series.values[..., first]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        duration_to_zero = sampled_interval * (first_values / delta)
+    clamp = (delta > 0) & (first_values >= 0) & (duration_to_zero < duration_to_start)
+    duration_to_start = np.where(clamp, duration_to_zero, duration_to_start)
+    duration_to_end = np.where(duration_to_end >= threshold, average_interval / 2, duration_to_end)
+
+    factor = (sampled_interval + duration_to_start + duration_to_end) / sampled_interval
+    if is_rate:
+        factor = factor / range_seconds
+    result[..., valid] = delta * factor
+    return result
+
+def rate(series: CounterSeries, eval_timestamps: np.ndarray, range_seconds: float) -> np.ndarray:
+    return _extrapolated_delta(series, eval_timestamps, range_seconds, is_rate=True)
+
+def increase(series: CounterSeries, eval_timestamps: np.ndarray, range_seconds: float) -> np.ndarray:
+    return _extrapolated_delta(series, eval_timestamps, range_seconds, is_rate=False)
+
+def irate(series: CounterSeries, eval_timestamps: np.ndarray, range_seconds: float) -> np.ndarray:
+    # per-second change between the last two samples of each window
+    eval_timestamps = np.asarray(eval_timestamps, dtype=np.float64)
+    result = np.full(series.values.shape[:-1] + eval_timestamps.shape, np.nan)
+    lower, upper = _window_bounds(series, eval_timestamps, range_seconds)
+    valid = upper - lower >= 2
+    last = upper[valid] - 1
+    previous = last - 1
+    delta = series.values[..., last] - series.values[..., previous]
+    delta = np.where(delta < 0, series.values[..., last], delta)
+    result[..., valid] = delta / (series.timestamps[last] - series.timestamps[previous])
+    return result
+
+def sum_of(function: Callable[[CounterSeries, np.ndarray, float], np.ndarray], series: Iterable[CounterSeries],
+           query: str, start: datetime, end: datetime, rate_interval: str, step: str = "3s") -> QueryRange:
+    # sum(function(series[rate_interval])) evaluated like a range query, timestamps where no series has a value are dropped
+    eval_timestamps = evaluation_timestamps(start, end, step)
+    range_seconds = duration_to_seconds(rate_interval)
+    total = np.zeros(eval_timestamps.shape, dtype=np.float64)
+    present = np.zeros(eval_timestamps.shape, dtype=bool)
+    for counter in series:
+        values = function(counter, eval_timestamps, range_seconds)
+        has_value = ~np.isnan(values)
+        total[has_value] += values[has_value]
+        present |= has_value
+    return QueryRange.from_arrays(query, eval_timestamps[present], total[present])
+
+def filter_series(series: Iterable[CounterSeries], label: str, allowed: Iterable[str]) -> List[CounterSeries]:
+    allowed = set(map(str, allowed))
+    return [counter for counter in series if counter.labels.get(label) in allowed]
@@ -0,0 +1,177 @@
+from datetime import datetime
+from itertools import product
+from typing import NamedTuple, List, Dict
+from prometheus import PromConnect, PromConfig
+from validation import ValidationConfig, ValidationQuery
+from stresser import StressProcessConfig, Local, time_interval_log_name
+from output import ErrorResult
+from store import ResultStore, validator_metadata
+from instrumentation import debug, logger
+import process.power as p
+import process.cpu_time as ct
+import asyncio
+import json
+import os
+
+VALIDATORS = {
+    "process_power": lambda prom, vc, config: p.NodeExporter(prom=prom, vc=vc, config=config),
+    "process_cpu_time": lambda prom, vc, config: ct.NodeExporter(prom=prom, vc=vc, config=config),
+}
+
+class MatrixConfig(NamedTuple):
+    prom: PromConfig
+    validators: List[str]
+    load_curves: List[str]
+    iterations: List[str]
+    rate_intervals: List[str]
+    # each job takes one of these cpu sets for its duration, so this also bounds concurrency
+    isolated_cpus: List[str]
+    checkpoint: str
+    mount_dir: str = "/tmp"
+    max_parallel: int = 0
+    # score each load phase's steady state and record errors per load level
+    by_phase: bool = False
+    phase_settle: str = "0s"
+    # result store directory every finished job is saved to, empty keeps only the checkpoint summary
+    store: str = ""
+    kepler_build: str = ""
+
+class Job(NamedTuple):
+    validator: str
+    load_curve: str
+    iterations: str
+    rate_interval: str
+
+    @property
+    def id(self) -> str:
+        return f"{self.validator}|{self.load_curve}|{self.iterations}|{self.rate_interval}"
+
+def load_matrix(path: str) -> MatrixConfig:
+    # yaml when the file says so, json otherwise
+    with open(path, "r") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            raw = yaml.safe_load(f)
+        else:
+            raw = json.load(f)
+    prom = raw["prometheus"]
+    unknown = set(raw["validators"]) - set(VALIDATORS)
+    if unknown:
+        raise ValueError(f"unknown validators in matrix: {sorted(unknown)}")
+    return MatrixConfig(
+        prom=PromConfig(url=prom["url"], disable_ssl=prom.get("disable_ssl", False)),
+        validators=raw["validators"],
+        load_curves=raw["load_curves"],
+        iterations=[str(iterations) for iterations in raw.get("iterations", ["1"])],
+        rate_intervals=raw["rate_intervals"],
+        isolated_cpus=[str(cpus) for cpus in raw["isolated_cpus"]],
+        checkpoint=os.path.expanduser(raw.get("checkpoint", "matrix_checkpoint.json")),
+        mount_dir=raw.get("mount_dir", "/tmp"),
+        max_parallel=raw.get("max_parallel", 0),
+        by_phase=raw.get("by_phase", False),
+        phase_settle=raw.get("phase_settle", "0s"),
+        store=os.path.expanduser(raw.get("store", "")),
+        kepler_build=str(raw.get("kepler_build", ""))
+    )
+
+class MatrixRunner:
+    # expands validators x load curves x iterations x rate intervals into jobs and works through them
+    # with bounded concurrency, checkpointing after every job so an interrupted matrix resumes where it stopped
+    def __init__(self, mc: MatrixConfig):
+        self.config = mc
+        self.prom = PromConnect(mc.prom)
+        self.jobs = [Job(*combination) for combination in product(mc.validators, mc.load_curves, mc.iterations, mc.rate_intervals)]
+        self.records = self._load_checkpoint()
+        self.store = ResultStore(mc.store) if mc.store else None
+
+    def pending(self) -> List[Job]:
+        # failed jobs are retried on resume, only finished ones are skipped
+        return [job for job in self.jobs if self.records.get(job.id, {}).get("status") != "done"]
+
+    async def run(self) -> Dict[str, dict]:
+        pending = self.pending()
+        debug("matrix", jobs=len(self.jobs), done=len(self.jobs) - len(pending), pending=len(pending))
+        free_cpus = asyncio.Queue()
+        for cpus in self.config.isolated_cpus:
+            free_cpus.put_nowait(cpus)
+        workers = min(self.config.max_parallel or len(self.config.isolated_cpus), len(self.config.isolated_cpus))
+        slots = asyncio.Semaphore(max(workers, 1))
+        try:
+            await asyncio.gather(*(self._run_job(job, free_cpus, slots) for job in pending))
+        finally:
+            await self.prom.close()
+        return self.records
+
+    async def _run_job(self, job: Job, free_cpus: asyncio.Queue, slots: asyncio.Semaphore) -> None:
+        async with slots:
+            cpus = await free_cpus.get()
+            try:
+                record = {"status": "failed", "isolated_cpus": cpus, "started_at": datetime.now().isoformat()}
+                try:
+                    validator = self._validator(job, cpus)
+                    result = await validator.validate()
+                    if result is None or len(result.actual) == 0:
+                        record["error"] = "validation produced no aligned samples"
+                    else:
+                        error = ErrorResult(result)
+                        record.update(status="done", samples=len(result.actual), mae=float(error.mae), mape=float(error.mape))
+                        if self.store:
+                            record["run_id"] = self.store.save(result, kepler_build=self.config.kepler_build, matrix_job=job.id, **validator_metadata(validator)).run_id
+                        if result.loads is not None:
+                            record["loads"] = {str(load): {"samples": level.count, "mae": level.mae, "mape": level.mape} for load, level in ErrorResult.by_load(result).items()}
+                except Exception as e:
+                    record["error"] = str(e)
+                record["finished_at"] = datetime.now().isoformat()
+                if record["status"] == "done":
+                    debug("matrix job done", job=job.id)
+                else:
+                    logger.error(f"matrix: {job.id} failed: {record['error']}")
+                self._checkpoint(job, record)
+            finally:
+                free_cpus.put_nowait(cpus)
+
+    def _validator(self, job: Job, cpus: str):
+        config = Local(
+            isolated_cpu=cpus,
+            load_curve=job.load_curve,
+            iterations=job.iterations,
+            container_name="",
+            mount_dir=self.config.mount_dir,
+            time_interval_log_name=time_interval_log_name(cpus)
+        )
+        vc = ValidationConfig(
+            vq=ValidationQuery(actual_query_name="actual", predicted_query_name="predicted"),
+            sc=StressProcessConfig(isolated_cpus=cpus.split(","), stress_load=100, stresser_timeout=120),
+            rate_interval=job.rate_interval,
+            by_phase=self.config.by_phase,
+            phase_settle=self.config.phase_settle
+        )
+        return VALIDATORS[job.validator](self.prom, vc, config)
+
+    def _load_checkpoint(self) -> Dict[str, dict]:
+        try:
+            with open(self.config.checkpoint, "r") as f:
+                return json.load(f)["jobs"]
+        except FileNotFoundError:
+            return {}
+
+    def _checkpoint(self, job: Job, record: dict) -> None:
+        # written to a temp file and renamed so a crash mid-write never corrupts the checkpoint
+        self.records[job.id] = record
+        temp_path = f"{self.config.checkpoint}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"jobs": self.records}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.config.checkpoint)
+
+def format_summary(records: Dict[str, dict]) -> str:
+    lines = []
+    for job_id, record in sorted(records.items()):
+        if record["status"] == "done":
+            lines.append(f"{job_id}: mae {record['mae']:.4f}, mape {record['mape']:.4%} over {record['samples']} samples")
+            for load, level in sorted(record.get("loads", {}).items(), key=lambda item: int(item[0])):
+                lines.append(f"    load {load}%: mae {level['mae']:.4f}, mape {level['mape']:.4%} over {level['samples']} samples")
+        else:
+            lines.append(f"{job_id}: failed, {record.get('error', '')}")
+    return "\n".join(lines)
@@ -0,0 +1,169 @@
+from validation import ValidationResult, ValidationQuery
+from datetime import datetime
+from typing import NamedTuple, List, Dict, Iterable, Iterator, Optional, Tuple
+import numpy as np
+import threading
+import shutil
+import uuid
+import json
+import os
+
+# persistent history of validation results. every run is a directory of .npy columns plus meta.json,
+# and index.jsonl holds one metadata line per run so runs can be filtered without opening them:
+#
+#   <root>/index.jsonl
+#   <root>/runs/<run_id>/meta.json
+#   <root>/runs/<run_id>/{timestamps,predicted,actual,loads}.npy
+#
+# columns are opened memory mapped, a scan only pages in the columns it reads
+
+COLUMNS = ("timestamps", "predicted", "actual", "loads")
+# RunMetadata fields save accepts as keyword arguments, anything else goes to extra
+SETTINGS = ("validator", "kepler_build", "load_curve", "isolated_cpu", "rate_interval", "step")
+INDEX_NAME = "index.jsonl"
+RUNS_DIR = "runs"
+
+class RunMetadata(NamedTuple):
+    run_id: str
+    created_at: str
+    samples: int
+    predicted_query: str
+    actual_query: str
+    validator: str = ""
+    # the kepler build or version under test, what cross-run comparisons usually group by
+    kepler_build: str = ""
+    load_curve: str = ""
+    isolated_cpu: str = ""
+    rate_interval: str = ""
+    step: str = ""
+    # anything else worth keeping with the run
+    extra: Dict[str, str] = {}
+
+def validator_metadata(validator) -> Dict[str, str]:
+    # the run settings a process validator carries, missing ones are left out
+    metadata = {"validator": f"{type(validator).__module__}.{type(validator).__name__}"}
+    stress_process = getattr(validator, "stress_process", None)
+    for key, owner, attribute in (
+        ("load_curve", stress_process, "load_curve"),
+        ("isolated_cpu", stress_process, "isolated_cpu"),
+        ("rate_interval", validator, "rate_interval"),
+        ("step", validator, "step"),
+    ):
+        value = getattr(owner, attribute, None)
+        if value is not None:
+            metadata[key] = str(value)
+    return metadata
+
+class ResultStore:
+    def __init__(self, root: str):
+        self.root = os.path.expanduser(root)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.root, RUNS_DIR), exist_ok=True)
+
+    def save(self, result: ValidationResult, **metadata) -> RunMetadata:
+        # columns are written to a temporary directory and renamed into place, so readers never see a partial run
+        created_at = datetime.now()
+        run_id = f"{created_at.strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        settings = {field: str(metadata.pop(field)) for field in SETTINGS if field in metadata}
+        meta = RunMetadata(
+            run_id=run_id,
+            created_at=created_at.isoformat(),
+            samples=int(len(result.actual)),
+            predicted_query=result.vq.predicted_query_name,
+            actual_query=result.vq.actual_query_name,
+            extra={key: str(value) for key, value in metadata.items()},
+            **settings
+        )
+        run_dir = self._run_dir(run_id)
+        temp_dir = f"{run_dir}.tmp"
+        os.makedirs(temp_dir)
+        try:
+            columns = {"predicted": np.asarray(result.predicted, dtype=np.float64), "actual": np.asarray(result.actual, dtype=np.float64)}
+            if result.timestamps is not None:
+                columns["timestamps"] = np.asarray(result.timestamps, dtype=np.int64)
+            if result.loads is not None:
+                columns["loads"] = np.asarray(result.loads, dtype=np.int64)
+            for name, column in columns.items():
+                np.save(os.path.join(temp_dir, f"{name}.npy"), column)
+            with open(os.path.join(temp_dir, "meta.json"), "w") as f:
+                json.dump(meta._asdict(), f, indent=2)
+            os.rename(temp_dir, run_dir)
+        except BaseException:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        with self._lock:
+            with open(os.path.join(self.root, INDEX_NAME), "a") as f:
+                f.write(json.dumps(meta._asdict()) + "\n")
+        return meta
+
+    def runs(self, since: str = "", until: str = "", **filters) -> List[RunMetadata]:
+        # metadata of every stored run matching the filters (exact field matches, created_at bounds as iso strings), oldest first
+        index_path = os.path.join(self.root, INDEX_NAME)
+        if not os.path.exists(index_path):
+            return []
+        runs = []
+        with open(index_path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                meta = RunMetadata(**json.loads(line))
+                if (since and meta.created_at < since) or (until and meta.created_at > until):
+                    continue
+                if any(str(getattr(meta, field, meta.extra.get(field, ""))) != str(value) for field, value in filters.items()):
+                    continue
+                runs.append(meta)
+        return runs
+
+    def column(self, run_id: str, name: str) -> Optional[np.ndarray]:
+        # a read-only memory map of one column, None when the run did not record it
+        if name not in COLUMNS:
+            raise ValueError(f"unknown column: {name}")
+        path = os.path.join(self._run_dir(run_id), f"{name}.npy")
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode="r")
+
+    def scan(self, columns: Iterable[str] = ("predicted", "actual"), **filters) -> Iterator[Tuple[RunMetadata, Dict[str, Optional[np.ndarray]]]]:
+        # one run at a time with only the requested columns mapped
+        columns = list(columns)
+        for meta in self.runs(**filters):
+            yield meta, {name: self.column(meta.run_id, name) for name in columns}
+
+    def load(self, run_id: str) -> ValidationResult:
+        with open(os.path.join(self._run_dir(run_id), "meta.json"), "r") as f:
+            meta = RunMetadata(**json.load(f))
+        return ValidationResult(
+            vq=ValidationQuery(actual_query_name=meta.actual_query, predicted_query_name=meta.predicted_query),
+            predicted=self.column(run_id, "predicted"),
+            actual=self.column(run_id, "actual"),
+            loads=self.column(run_id, "loads"),
+            timestamps=self.column(run_id, "timestamps")
+        )
+
+    def _run_dir(self, run_id: str) -> str:
+        return os.path.join(self.root, RUNS_DIR, run_id)
+
+def compare_runs(store: ResultStore, group_by: str = "kepler_build", **filters) -> Dict[str, dict]:
+    # error metrics per group of runs, e.g. per kepler build. only the predicted and actual columns are read,
+    # one run at a time, and each group is reduced from running sums
+    from output import MAPE_EPSILON
+    groups: Dict[str, dict] = {}
+    for meta, columns in store.scan(("predicted", "actual"), **filters):
+        key = str(getattr(meta, group_by, meta.extra.get(group_by, "")))
+        group = groups.setdefault(key, {"runs": 0, "samples": 0, "abs_error_sum": 0.0, "ape_sum": 0.0, "square_error_sum": 0.0})
+        error = columns["predicted"] - columns["actual"]
+        group["runs"] += 1
+        group["samples"] += error.size
+        group["abs_error_sum"] += float(np.abs(error).sum())
+        group["ape_sum"] += float((np.abs(error) / np.maximum(np.abs(columns["actual"]), MAPE_EPSILON)).sum())
+        group["square_error_sum"] += float(np.square(error).sum())
+    return {
+        key: {
+            "runs": group["runs"],
+            "samples": group["samples"],
+            "mae": group["abs_error_sum"] / group["samples"] if group["samples"] else float("nan"),
+            "mape": group["ape_sum"] / group["samples"] if group["samples"] else float("nan"),
+            "rmse": (group["square_error_sum"] / group["samples"]) ** 0.5 if group["samples"] else float("nan"),
+        }
+        for key, group in groups.items()
+    }
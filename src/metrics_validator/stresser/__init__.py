@@ -1,10 +1,11 @@
-import subprocess
+import asyncio
 from datetime import datetime
-import time
-from typing import NamedTuple, Set, List, Iterable
-import docker
-from utils import return_child_pids
+from typing import NamedTuple, Set, List, Iterable, Tuple
+from utils import track_descendants, PidTracker
+from instrumentation import span, debug, logger
 import os
+import re
+import signal
 # from kubernetes import client, config
 # from kubernetes.client.rest import ApiException
 
@@ -150,33 +151,48 @@ class StressKubeJobOutput(NamedTuple):
 class StressContainer:
     def __init__(self, sc: StressContainerConfig):
         self.isolated_cpus = sc.isolated_cpus
-        self.stress_script = sc.stress_script
+        self.stress_script = os.path.abspath(sc.stress_script)
         self.container_name = sc.container_name
+        # docker is only loaded for container validation
+        import docker
         self.client = docker.from_env()
         self.generate_new_stress_command()
+        self._image = None
 
     @property
-    def stress_command(self) -> str:
+    def stress_command(self) -> List[str]:
         return self._stress_command
 
+    async def image(self) -> str:
+        # resolved once per StressContainer, the image itself is reused across runs until its content changes
+        if self._image is None:
+            from stresser.image import ensure_stress_image
+            self._image = await asyncio.to_thread(ensure_stress_image, self.client, self.stress_script)
+        return self._image
+
     def generate_new_stress_command(self):
         # store these in a field
         #load = "0:5,50:20,75:20,100:20,75:20,50:20,0:10"
         load="100:20"
         mount_dir = "/tmp"
-        self._stress_command = f"bash -c 'dnf update -y && dnf install -y stress-ng && bash /app/stress_script.sh -l \"{load}\" -d \"{mount_dir}\" '"
+        # arguments to the image entrypoint, the stress script baked into the image
+        self._stress_command = ["-l", load, "-d", mount_dir]
         
 
-    def stress(self) -> StressContainerOutput:
-        image = "fedora:latest"
+    async def stress(self) -> StressContainerOutput:
+        with span("stress", stresser="container", container_name=self.container_name):
+            return await self._stress()
+
+    async def _stress(self) -> StressContainerOutput:
         try:
-            self.client.images.pull(image)
-            stress_container = self.client.containers.run(
+            # the docker client is blocking, every call runs on a worker thread so the event loop stays free
+            image = await self.image()
+            stress_container = await asyncio.to_thread(
+                self.client.containers.run,
                 image=image,
                 name=self.container_name,
                 command=self.stress_command,
                 volumes={
-                    self.stress_script: {'bind': '/app/stress_script.sh', 'mode': 'ro'},
                     '/tmp' :{'bind': '/tmp', 'mode': 'rw'}
                 },
                 remove=False,
@@ -184,11 +200,11 @@ class StressContainer:
 
             )
             id = stress_container.id
-            print(f"Container ID: {id}")
-            status_map = stress_container.wait()
-            print(stress_container.logs().decode("utf-8"))
-            stress_container.remove()
-            print(status_map)
+            debug("container started", container_id=id)
+            status_map = await asyncio.to_thread(stress_container.wait)
+            debug("container logs", logs=(await asyncio.to_thread(stress_container.logs)).decode("utf-8"))
+            await asyncio.to_thread(stress_container.remove)
+            debug("container exited", status=status_map)
             if status_map["StatusCode"] != 0:
                 raise Exception("stress script had an exit code of 0")
 
@@ -209,8 +225,7 @@ class StressContainer:
             if not start_time or not end_time:
                 raise Exception("start time or end time is empty")
 
-            print(start_time)
-            print(end_time)
+            debug("stress interval", start=start_time, end=end_time)
             return StressContainerOutput(
                 start_time=start_time,
                 end_time=end_time,
@@ -218,7 +233,7 @@ class StressContainer:
             )
 
         except Exception as e:
-            print(f"Stress Container Error: {e}")
+            logger.error(f"Stress Container Error: {e}")
             raise Exception(f"Stress Container Error: {e}")
 
 
@@ -228,7 +243,7 @@ class StressProcess:
         self.stress_load = sc.stress_load
         self.stresser_timeout = sc.stresser_timeout
         self.generate_new_stress_command()
-        print(self.stress_command)
+        debug("stress command", command=self.stress_command)
 
     @property
     def stress_command(self) -> str:
@@ -242,18 +257,17 @@ class StressProcess:
         # replace stress command with a script
         self._stress_command = f"taskset -c {cpus} stress-ng --cpu {cpu_num} --cpu-load {self.stress_load} --cpu-method ackermann --timeout {self.stresser_timeout}s"
 
-    def stress(self):
-        start_time = datetime.now()
-        target_popen = subprocess.Popen(self.stress_command, shell=True)
-        time.sleep(1)
-        target_process_pid = target_popen.pid
-        all_child_pids = set([target_process_pid])
-        while target_popen.poll() is None:
-            child_pids = return_child_pids(target_process_pid)
-            all_child_pids = all_child_pids.union(child_pids)
-            time.sleep(1)
-        end_time = datetime.now()
-        
+    async def stress(self):
+        with span("stress", stresser="stress-ng", cpus=",".join(self.isolated_cpus)):
+            start_time = datetime.now()
+            target_popen = await asyncio.create_subprocess_shell(self.stress_command)
+            with span("pid_tracking") as tracking_span:
+                tracker = track_descendants(target_popen.pid)
+                await target_popen.wait()
+                end_time = datetime.now()
+                all_child_pids = tracker.stop()
+                tracking_span.set(pids=len(all_child_pids), tracker=type(tracker).__name__)
+
         return StressProcessOutput(
             start_time=start_time,
             end_time=end_time,
@@ -269,6 +283,8 @@ class Local(NamedTuple):
     container_name: str
     mount_dir: str
     #stressor_script: str
+    # runs sharing a mount_dir need distinct log names so concurrent runs do not overwrite each other
+    time_interval_log_name: str = "time_interval.log"
 
     def __repr__(self):
         if self.isolated_cpu:
@@ -277,6 +293,10 @@ class Local(NamedTuple):
             isolated_cpu = "None"
         return f"Local isolated_cpu: {isolated_cpu}, load_curve: {self.load_curve}, iterations: {self.iterations}"
 
+def time_interval_log_name(isolated_cpu: str) -> str:
+    # the per run log name for runs that share a mount_dir, one per isolated cpu set
+    return f"time_interval_cpu{isolated_cpu.replace(',', '_')}.log"
+
     
 class Process:
     def __init__(self, config: Local):
@@ -284,25 +304,60 @@ class Process:
         self.load_curve = config.load_curve
         self.iterations = config.iterations
         self.mount_dir = config.mount_dir
-        self.time_range_log = os.path.join(self.mount_dir, "time_interval.log")
+        self.time_interval_log_name = config.time_interval_log_name
+        self.time_range_log = os.path.join(self.mount_dir, self.time_interval_log_name)
         stresser_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
         self.stressor_script =os.path.join(stresser_dir, "targeted_stresser.sh")
 
     def __repr__(self):
         return f"<Local> Process Stresser\n\Load Curve: {self.load_curve}"
 
-    def stress(self):
-        command = f"{self.stressor_script} -r '{self.isolated_cpu}' -d {self.mount_dir} -l {self.load_curve} -n {self.iterations}"
-        print(command)
-        target_popen = subprocess.Popen(command, shell=True)
-        time.sleep(1)
-        target_process_pid = target_popen.pid
-        all_child_pids = set([target_process_pid])
-        while target_popen.poll() is None:
-            child_pids = return_child_pids(target_process_pid)
-            all_child_pids = all_child_pids.union(child_pids)
-            time.sleep(1)
-        
+    async def start(self) -> asyncio.subprocess.Process:
+        # exec the script directly rather than through a shell so the popen pid is the script itself. it leads
+        # its own process group, which abort signals as a whole
+        command = [self.stressor_script, "-r", self.isolated_cpu, "-d", self.mount_dir, "-t", self.time_interval_log_name, "-l", self.load_curve, "-n", str(self.iterations)]
+        debug("stress script", command=" ".join(command))
+        return await asyncio.create_subprocess_exec(*command, start_new_session=True)
+
+    def track(self, target_popen: asyncio.subprocess.Process) -> PidTracker:
+        # records every descendant as it is forked, stress-ng workers that live under a second included
+        return track_descendants(target_popen.pid)
+
+    async def abort(self, target_popen: asyncio.subprocess.Process, timeout: float = 10) -> None:
+        # TERM to the script's whole group: the script traps it and waits for its stress-ng children, which get it
+        # too. whatever is left after timeout is killed, and a descendant surviving that is an error
+        group = target_popen.pid
+        if target_popen.returncode is None:
+            _signal_group(group, signal.SIGTERM)
+            try:
+                await asyncio.wait_for(target_popen.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"stress script {group} ignored SIGTERM for {timeout}s, killing its process group")
+        _signal_group(group, signal.SIGKILL)
+        if target_popen.returncode is None:
+            await target_popen.wait()
+        deadline = asyncio.get_running_loop().time() + timeout
+        while _signal_group(group, 0):
+            if asyncio.get_running_loop().time() > deadline:
+                raise StresserError(script_exit_code=target_popen.returncode, message=f"processes of stress script group {group} survived abort")
+            await asyncio.sleep(0.1)
+
+    async def stress(self):
+        with span("stress", stresser="script", cpus=self.isolated_cpu, load_curve=self.load_curve, iterations=self.iterations):
+            return await self._stress()
+
+    async def _stress(self):
+        target_popen = await self.start()
+        with span("pid_tracking") as tracking_span:
+            tracker = self.track(target_popen)
+            try:
+                await target_popen.wait()
+            finally:
+                # the script runs in its own session, an interrupted validation has to stop it itself
+                await self.abort(target_popen)
+                all_child_pids = tracker.stop()
+            tracking_span.set(pids=len(all_child_pids), tracker=type(tracker).__name__)
+
         status_code = target_popen.returncode
         if status_code != 0:
             raise StresserError(
@@ -311,6 +366,7 @@ class Process:
             )
 
         start_time, end_time = retrieve_time_interval_from_log(self.time_range_log)
+        phases = retrieve_phases_from_log(self.time_range_log)
 
         if not start_time or not end_time:
             raise StresserError(
@@ -322,11 +378,20 @@ class Process:
         return ProcessOutput(
             script_result=ScriptResult(
                 start_time=start_time,
-                end_time=end_time
+                end_time=end_time,
+                phases=phases
             ),
             relevant_pids=all_child_pids
         )
     
+def _signal_group(group: int, signum: int) -> bool:
+    # whether the process group still had a member to signal
+    try:
+        os.killpg(group, signum)
+        return True
+    except ProcessLookupError:
+        return False
+
 class StresserError(Exception):
     def __init__(self, start_time="", end_time="", script_exit_code=0, message=""):
         super().__init__(message)
@@ -338,9 +403,18 @@ class StresserError(Exception):
         return f"Start Time: {self.start_time}\nEnd Time: {self.end_time}\nScript Code: {self.script_exit_code}"
     
 
+class Phase(NamedTuple):
+    # one load curve entry as it ran, numbered from 1 across iterations
+    index: int
+    load: int
+    start_time: datetime
+    end_time: datetime
+
+
 class ScriptResult(NamedTuple):
     start_time: datetime
     end_time: datetime
+    phases: Tuple[Phase, ...] = ()
 
 
 class ProcessOutput(NamedTuple):
@@ -366,3 +440,21 @@ def retrieve_time_interval_from_log(time_interval_filepath):
                 end_time = datetime.fromtimestamp(float(end_timestamp))
     return start_time, end_time
 
+_PHASE_LINE = re.compile(r"Phase (\d+) Load (\d+) (Start|End) Time: ([\d.]+)")
+
+def retrieve_phases_from_log(time_interval_filepath) -> Tuple[Phase, ...]:
+    # phases whose start and end were both logged, an aborted run leaves its last phase open and it is skipped
+    starts = {}
+    phases = []
+    with open(file=time_interval_filepath, mode="r") as f:
+        for line in f.readlines():
+            match = _PHASE_LINE.match(line.strip())
+            if not match:
+                continue
+            index, load, boundary, timestamp = int(match.group(1)), int(match.group(2)), match.group(3), float(match.group(4))
+            if boundary == "Start":
+                starts[index] = (load, datetime.fromtimestamp(timestamp))
+            elif index in starts:
+                load, start_time = starts.pop(index)
+                phases.append(Phase(index, load, start_time, datetime.fromtimestamp(timestamp)))
+    return tuple(sorted(phases))
@@ -0,0 +1,39 @@
+from docker.errors import ImageNotFound
+from instrumentation import span, debug
+import hashlib
+import io
+import os
+import tarfile
+
+STRESS_IMAGE_REPOSITORY = "metrics-validator-stress"
+DOCKERFILE_PATH = os.path.join(os.path.dirname(__file__), "Dockerfile")
+
+def stress_image_tag(stress_script: str) -> str:
+    # the tag is the hash of everything baked into the image, so editing either file yields a new tag
+    digest = hashlib.sha256()
+    for path in (DOCKERFILE_PATH, stress_script):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return f"{STRESS_IMAGE_REPOSITORY}:{digest.hexdigest()[:16]}"
+
+def _build_context(stress_script: str) -> io.BytesIO:
+    # only the two files the Dockerfile needs are sent to the daemon
+    context = io.BytesIO()
+    with tarfile.open(fileobj=context, mode="w") as tar:
+        tar.add(DOCKERFILE_PATH, arcname="Dockerfile")
+        tar.add(stress_script, arcname="stress_script.sh")
+    context.seek(0)
+    return context
+
+def ensure_stress_image(client, stress_script: str) -> str:
+    # returns the tag of the stress image for this script, building it only when no image with that content exists
+    tag = stress_image_tag(stress_script)
+    try:
+        client.images.get(tag)
+        return tag
+    except ImageNotFound:
+        pass
+    with span("stress_image_build", tag=tag):
+        debug("building stress image", tag=tag)
+        client.images.build(fileobj=_build_context(stress_script), custom_context=True, tag=tag, rm=True)
+    return tag
@@ -0,0 +1,81 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from typing import NamedTuple, List
+from output import ErrorResult
+from utils import duration_to_seconds
+import process.power as p
+import asyncio
+import math
+import os
+
+class SweepConfig(NamedTuple):
+    rate_intervals: List[str]
+    steps: List[str]
+    # worker processes for the evaluation grid, 0 uses every core
+    workers: int = 0
+
+class SweepPoint(NamedTuple):
+    rate_interval: str
+    step: str
+    samples: int
+    mae: float
+    mape: float
+
+# set once per worker process so the counters are pickled per worker rather than per grid point
+_worker_validator = None
+_worker_counters = None
+
+def _init_worker(validator: p.NodeExporter, counters: p.PowerCounters) -> None:
+    global _worker_validator, _worker_counters
+    _worker_validator = validator
+    _worker_counters = counters
+
+def _evaluate_point(rate_interval: str, step: str) -> SweepPoint:
+    result = _worker_validator.evaluate_counters(_worker_counters, rate_interval, step)
+    if len(result.actual) == 0:
+        return SweepPoint(rate_interval, step, 0, math.nan, math.nan)
+    error = ErrorResult(result)
+    return SweepPoint(rate_interval, step, len(result.actual), float(error.mae), float(error.mape))
+
+class Sweep:
+    # runs the stressor and downloads the raw counters once, then scores every
+    # (rate_interval, step) combination locally, spread across processes
+    def __init__(self, validator: p.NodeExporter, sc: SweepConfig):
+        if not sc.rate_intervals or not sc.steps:
+            raise ValueError("sweep needs at least one rate interval and one step")
+        self.validator = validator
+        self.rate_intervals = sc.rate_intervals
+        self.steps = sc.steps
+        self.workers = sc.workers or os.cpu_count() or 1
+
+    async def run(self) -> List[SweepPoint]:
+        stress_output = await self.validator.stress_process.stress()
+        # the widest interval decides how far back the raw samples must reach
+        lookback = max(self.rate_intervals, key=duration_to_seconds)
+        counters = await self.validator.fetch_counters(stress_output, lookback)
+        # the grid is cpu bound, it runs off the event loop
+        return await asyncio.to_thread(self.evaluate, counters)
+
+    def evaluate(self, counters: p.PowerCounters) -> List[SweepPoint]:
+        grid = list(product(self.rate_intervals, self.steps))
+        workers = min(self.workers, len(grid))
+        if workers <= 1:
+            _init_worker(self.validator, counters)
+            points = [_evaluate_point(rate_interval, step) for rate_interval, step in grid]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.validator, counters)) as executor:
+                points = list(executor.map(
+                    _evaluate_point,
+                    [rate_interval for rate_interval, _ in grid],
+                    [step for _, step in grid]
+                ))
+        # best agreement first, combinations without aligned samples last
+        return sorted(points, key=lambda point: (math.isnan(point.mape), point.mape, point.mae))
+
+def format_table(points: List[SweepPoint]) -> str:
+    header = f"{'rate_interval':>13}  {'step':>6}  {'samples':>7}  {'MAE':>12}  {'MAPE':>10}"
+    lines = [header, "-" * len(header)]
+    for index, point in enumerate(points):
+        marker = "  <- best" if index == 0 and not math.isnan(point.mape) else ""
+        lines.append(f"{point.rate_interval:>13}  {point.step:>6}  {point.samples:>7}  {point.mae:>12.4f}  {point.mape:>10.4%}{marker}")
+    return "\n".join(lines)
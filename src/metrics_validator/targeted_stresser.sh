@@ -2,14 +2,18 @@
 
 set -eu -o pipefail
 
-trap exit_all INT
+trap exit_all INT TERM
 exit_all() {
-	pkill -P $$
+	pkill -P $$ || true
+	wait
+	exit 130
 }
 
 run() {
 	echo "❯ $*"
-	"$@"
+	# started in the background and waited on, bash only runs the INT TERM trap once a foreground child has exited
+	"$@" &
+	wait $!
 	echo "      ‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾‾"
 }
 
@@ -19,7 +23,7 @@ usage() {
     echo "  -r <cpu_range>   CPU range for stress-ng taskset (Default: '15')"
     echo "  -c <cpus>    Number of CPUs to use for stress-ng (Default: '1')"
     echo "  -d <mount_dir>   Directory to mount for logging (Default: '/tmp')"
-    echo "  -t <time_interval_log_name> Filename for start and end time file log (Default: 'time_interval.log')"
+    echo "  -t <time_interval_log_name> Filename for start, end and per phase time log (Default: 'time_interval.log')"
     echo "  -l <load_curve>  Load curve as a comma-separated list (Default: '0:5,50:20,75:20,100:20,75:20,50:20')"
     echo "  -n <iterations> Number of times to iterate the Load curve (Default: '1')"
     exit 1
@@ -65,16 +69,20 @@ main() {
     start_time=$(date +%s)
     echo "Stress Start Time: $start_time" >> "$TIME_INTERVAL_LOG"
 
+    phase=0
     for i in $(seq 1 "$iterations"); do
         echo "Running $i/$iterations"
         for x in "${load_curve[@]}"; do
             local load="${x%%:*}"
             local time="${x##*:}s"
+            phase=$((phase + 1))
+            echo "Phase $phase Load $load Start Time: $(date +%s.%N)" >> "$TIME_INTERVAL_LOG"
             if $set_general_mode; then
                 run stress-ng --cpu "$cpus" --cpu-method ackermann --cpu-load "$load" --timeout "$time"
             else
                 run taskset -c "$cpu_range" stress-ng --cpu "$cpus" --cpu-method ackermann --cpu-load "$load" --timeout "$time"
             fi
+            echo "Phase $phase Load $load End Time: $(date +%s.%N)" >> "$TIME_INTERVAL_LOG"
         done
     done 
 
@@ -0,0 +1,10 @@
+from benchmark import HEAVY_MODULES, IMPORT_BUDGET_SECONDS, check_imports, import_violations
+
+# every command imports the subsystems it uses inside its handler, this keeps it that way
+
+def test_heavy_modules_cover_optional_dependencies():
+    for module in ("docker", "sklearn", "matplotlib", "prometheus_api_client", "psutil"):
+        assert module in HEAVY_MODULES
+
+def test_imports_within_budget():
+    assert import_violations(check_imports(), IMPORT_BUDGET_SECONDS) == []
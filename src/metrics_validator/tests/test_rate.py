@@ -0,0 +1,38 @@
+from prometheus import PromConnect, PromConfig
+from prometheus.fake import SyntheticKepler, SyntheticConfig, FakePrometheus
+from prometheus.rate import rate, sum_of, evaluation_timestamps
+from datetime import datetime, timedelta
+import numpy as np
+import asyncio
+
+def test_evaluation_timestamps_step_from_the_exact_start():
+    start = datetime.fromtimestamp(1_700_000_000.25)
+    timestamps = evaluation_timestamps(start, start + timedelta(seconds=10), "3s")
+    np.testing.assert_array_equal(timestamps, 1_700_000_000.25 + np.array([0.0, 3.0, 6.0, 9.0]))
+
+def test_local_rate_matches_server_at_fractional_start():
+    kepler = SyntheticKepler(SyntheticConfig(pids=5, duration="15m", end=1_700_000_000))
+    server = FakePrometheus(kepler).start()
+    # a phase window starting between two scrapes, as the stress script logs them. rounded to the second it
+    # would take in a different scrape at the start of every rate window
+    start = datetime.fromtimestamp(float(kepler.timestamps[0]) + 301.6)
+    end = start + timedelta(minutes=5)
+    query = "sum(rate(kepler_process_package_joules_total[20s]))"
+
+    async def fetch():
+        prom = PromConnect(PromConfig(url=server.url, disable_ssl=True))
+        try:
+            counters = await prom.get_counter_series("kepler_process_package_joules_total", start, end, "20s")
+            remote = await prom.get_metric_range(query, start, end, "3s")
+        finally:
+            await prom.close()
+        return counters, remote
+
+    try:
+        counters, remote = asyncio.run(fetch())
+    finally:
+        server.stop()
+    local = sum_of(rate, counters, query, start, end, "20s", "3s")
+    assert len(local) == len(remote) > 90
+    np.testing.assert_array_equal(local.timestamps, remote.timestamps)
+    np.testing.assert_allclose(local.samples, remote.samples, rtol=1e-9)
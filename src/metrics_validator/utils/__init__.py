@@ -1,10 +1,216 @@
-from typing import List
-import psutil
+from typing import List, Set, Iterable
+from abc import ABC, abstractmethod
+import threading
+import socket
+import struct
+import errno
+import re
+import os
 
 def return_child_pids(parent_pid: int) -> List[int]:
+    # psutil is only loaded on hosts that fall back to polling
+    import psutil
     try:
         parent_process = psutil.Process(parent_pid)
         children_processes = parent_process.children(recursive=True)
         return [child_process.pid for child_process in children_processes]
     except psutil.NoSuchProcess:
-        return []
\ No newline at end of file
+        return []
+
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800, "y": 31536000}
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h|d|w|y)")
+
+def duration_to_seconds(duration: str) -> float:
+    # accepts prometheus durations ("3s", "1m30s") as well as plain float seconds ("15")
+    duration = str(duration).strip()
+    try:
+        return float(duration)
+    except ValueError:
+        pass
+    parts = _DURATION_PATTERN.findall(duration)
+    if not parts or "".join(number + unit for number, unit in parts) != duration:
+        raise ValueError(f"invalid duration: {duration}")
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+def parse_cpu_list(cpu_list: str) -> Set[int]:
+    # taskset style cpu list, e.g. "5" or "0-3,8"
+    cpus = set()
+    for part in str(cpu_list).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+class PidTracker(ABC):
+    # records every process descended from root_pid while it runs, including short lived ones
+    def __init__(self, root_pid: int):
+        self.root_pid = root_pid
+        self._pids = {root_pid}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def pids(self) -> Set[int]:
+        with self._lock:
+            return set(self._pids)
+
+    def start(self) -> "PidTracker":
+        # processes forked before tracking began are picked up by an initial walk of the tree
+        self._add(_walk_proc_tree(self._pids))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> Set[int]:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        return self.pids
+
+    def _add(self, pids: Iterable[int]) -> None:
+        with self._lock:
+            self._pids.update(pids)
+
+    @abstractmethod
+    def _run(self) -> None:
+        # records pids until _stopped is set, on the tracker's own thread
+        pass
+
+
+class ProcConnectorTracker(PidTracker):
+    # fork events pushed by the kernel over the netlink process connector, needs CAP_NET_ADMIN
+    def __init__(self, root_pid: int):
+        super().__init__(root_pid)
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, _NETLINK_CONNECTOR)
+        try:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            self._socket.bind((0, _CN_IDX_PROC))
+            self._socket.settimeout(0.2)
+            self._send_listen(_PROC_CN_MCAST_LISTEN)
+        except OSError:
+            self._socket.close()
+            raise
+
+    def _send_listen(self, op: int) -> None:
+        payload = struct.pack("=I", op)
+        cn_msg = struct.pack("=IIIIHH", _CN_IDX_PROC, _CN_VAL_PROC, 0, 0, len(payload), 0) + payload
+        header = struct.pack("=IHHII", 16 + len(cn_msg), _NLMSG_DONE, 0, 0, 0)
+        self._socket.send(header + cn_msg)
+
+    def _run(self) -> None:
+        try:
+            while not self._stopped.is_set():
+                try:
+                    data = self._socket.recv(65536)
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    if e.errno == errno.ENOBUFS:
+                        # events were dropped, catch up by walking the tree
+                        self._add(_walk_proc_tree(self.pids))
+                        continue
+                    raise
+                self._handle(data)
+        finally:
+            try:
+                self._send_listen(_PROC_CN_MCAST_IGNORE)
+            except OSError:
+                pass
+            self._socket.close()
+
+    def _handle(self, data: bytes) -> None:
+        offset = 0
+        while offset + 16 <= len(data):
+            message_length = struct.unpack_from("=I", data, offset)[0]
+            if message_length < 16:
+                return
+            # nlmsghdr (16) + cn_msg (20) + proc_event what, cpu, timestamp (16)
+            event = offset + 36
+            if event + 32 <= offset + message_length:
+                what = struct.unpack_from("=I", data, event)[0]
+                if what == _PROC_EVENT_FORK:
+                    _, parent_tgid, child_pid, child_tgid = struct.unpack_from("=IIII", data, event + 16)
+                    # new threads share the parent's tgid, only new processes are recorded
+                    if child_pid == child_tgid:
+                        with self._lock:
+                            if parent_tgid in self._pids:
+                                self._pids.add(child_tgid)
+            offset += (message_length + 3) & ~3
+
+
+class ProcTreeTracker(PidTracker):
+    # fallback that rereads /proc/<pid>/task/<tid>/children for the tracked tree only, never the whole process table
+    def __init__(self, root_pid: int, interval: float = 0.05):
+        super().__init__(root_pid)
+        self.interval = interval
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self._add(_walk_proc_tree(self.pids))
+        self._add(_walk_proc_tree(self.pids))
+
+
+class PsutilTracker(PidTracker):
+    # last resort for kernels without /proc/<pid>/task/<tid>/children
+    def __init__(self, root_pid: int, interval: float = 1):
+        super().__init__(root_pid)
+        self.interval = interval
+
+    def start(self) -> "PidTracker":
+        self._add(return_child_pids(self.root_pid))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self._add(return_child_pids(self.root_pid))
+
+
+def track_descendants(root_pid: int) -> PidTracker:
+    # cheapest tracker the host supports, already started
+    try:
+        return ProcConnectorTracker(root_pid).start()
+    except OSError:
+        pass
+    if os.path.exists(f"/proc/{root_pid}/task/{root_pid}/children"):
+        return ProcTreeTracker(root_pid).start()
+    return PsutilTracker(root_pid).start()
+
+
+def _walk_proc_tree(known_pids: Iterable[int]) -> Set[int]:
+    found = set()
+    pending = list(known_pids)
+    while pending:
+        pid = pending.pop()
+        try:
+            task_ids = os.listdir(f"/proc/{pid}/task")
+        except OSError:
+            continue
+        for task_id in task_ids:
+            try:
+                with open(f"/proc/{pid}/task/{task_id}/children") as f:
+                    children = f.read().split()
+            except OSError:
+                continue
+            for child in map(int, children):
+                if child not in found:
+                    found.add(child)
+                    pending.append(child)
+    return found
+
+
+_NETLINK_CONNECTOR = 11
+_CN_IDX_PROC = 1
+_CN_VAL_PROC = 1
+_NLMSG_DONE = 3
+_PROC_CN_MCAST_LISTEN = 1
+_PROC_CN_MCAST_IGNORE = 2
+_PROC_EVENT_FORK = 0x00000001
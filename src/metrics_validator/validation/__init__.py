@@ -1,15 +1,56 @@
-from typing import NamedTuple, List, Iterable, Set
+from typing import NamedTuple, List, Iterable, Optional, Tuple, Callable, Awaitable
+from datetime import datetime, timedelta
 from abc import ABC, abstractmethod
-from stresser import StressProcessConfig
+from stresser import StressProcessConfig, Phase
+from utils import duration_to_seconds
+from instrumentation import span
+import asyncio
+import numpy as np
 
 # everything below should be in validation module
 class DataPoint(NamedTuple):
     timestamp: int
     value: float
 
-class QueryRange(NamedTuple):
+class QueryRange:
+    # columnar storage: parallel int64 timestamps and float64 samples, sorted by timestamp
     query: str
-    values: List[DataPoint]
+    timestamps: np.ndarray
+    samples: np.ndarray
+
+    def __init__(self, query: str, values: Iterable[DataPoint] = ()):
+        values = list(values)
+        timestamps = np.fromiter((datapoint[0] for datapoint in values), dtype=np.int64, count=len(values))
+        samples = np.fromiter((datapoint[1] for datapoint in values), dtype=np.float64, count=len(values))
+        self._set_columns(query, timestamps, samples)
+
+    @classmethod
+    def from_arrays(cls, query: str, timestamps: np.ndarray, samples: np.ndarray) -> "QueryRange":
+        query_range = cls.__new__(cls)
+        query_range._set_columns(query, np.asarray(timestamps, dtype=np.int64), np.asarray(samples, dtype=np.float64))
+        return query_range
+
+    def _set_columns(self, query: str, timestamps: np.ndarray, samples: np.ndarray) -> None:
+        if timestamps.shape != samples.shape:
+            raise ValueError(f"timestamps and samples differ in length for query: {query}")
+        if timestamps.size > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind="stable")
+            timestamps = timestamps[order]
+            samples = samples[order]
+        self.query = query
+        self.timestamps = timestamps
+        self.samples = samples
+        self._values = None
+
+    @property
+    def values(self) -> List[DataPoint]:
+        # compatibility view for callers that iterate DataPoints, built once on first access
+        if self._values is None:
+            self._values = [DataPoint(timestamp, value) for timestamp, value in zip(self.timestamps.tolist(), self.samples.tolist())]
+        return self._values
+
+    def __len__(self) -> int:
+        return self.timestamps.size
 
     def __str__(self) -> str:
         return f"query: {self.query}, values: {self.values}"
@@ -17,30 +58,178 @@ class QueryRange(NamedTuple):
 class ValidationQuery(NamedTuple):
     actual_query_name: str
     predicted_query_name: str
-    
+
 class ValidationConfig(NamedTuple):
     vq: ValidationQuery
     sc: StressProcessConfig
     rate_interval: str
+    # how validators line up their series, see align
+    join_mode: str = "exact"
+    join_tolerance: int = 0
+    step: str = "3s"
+    # fetch raw counters once and evaluate rate() locally instead of on the server
+    local_rate: bool = False
+    # score only the steady state of each load phase instead of the whole run, see steady_windows
+    by_phase: bool = False
+    phase_settle: str = "0s"
+    # load levels to score when by_phase is set, empty scores every level
+    phase_loads: Tuple[int, ...] = ()
+    # also have prometheus evaluate the locally computed expressions and compare, see prometheus.plan
+    verify: bool = False
 
 class ValidationResult(NamedTuple):
     vq: ValidationQuery
-    predicted: List[float]
-    actual: List[float]
+    predicted: np.ndarray
+    actual: np.ndarray
+    # load level of every sample when scored by phase
+    loads: Optional[np.ndarray] = None
+    # unix seconds of every aligned sample
+    timestamps: Optional[np.ndarray] = None
 
 class Validator(ABC):
     @abstractmethod
-    def validate(self) -> ValidationResult:
+    async def validate(self) -> ValidationResult:
         """Validate Target Metrics"""
         pass
 
-def common_timestamps(range_one: QueryRange, range_two: QueryRange) -> Set[int]:
-    timestamps_one = set([range_one_val.timestamp for range_one_val in range_one.values])
-    timestamps_two = set(range_two_val.timestamp for range_two_val in range_two.values)
-    timestamps = timestamps_one.intersection(timestamps_two)
-    return timestamps
+EXACT_JOIN = "exact"
+NEAREST_JOIN = "nearest"
+ASOF_JOIN = "asof"
+
+def _sorted_membership(haystack: np.ndarray, needles: np.ndarray) -> np.ndarray:
+    # mask over haystack of values present in needles, both sorted, done by binary search instead of hashing
+    if haystack.size == 0 or needles.size == 0:
+        return np.zeros(haystack.shape, dtype=bool)
+    positions = np.searchsorted(needles, haystack)
+    positions[positions == needles.size] = needles.size - 1
+    return needles[positions] == haystack
+
+def common_timestamps(range_one: QueryRange, range_two: QueryRange) -> np.ndarray:
+    return range_one.timestamps[_sorted_membership(range_one.timestamps, range_two.timestamps)]
 
 def keep_timestamps(timestamps: Iterable[int], query_range: QueryRange) -> QueryRange:
-    aligned_range = [DataPoint(datapoint.timestamp, datapoint.value) for datapoint in query_range.values if datapoint.timestamp in timestamps]
-    aligned_range.sort(key=lambda datapoint: datapoint.timestamp)
-    return QueryRange(query_range.query, aligned_range)
\ No newline at end of file
+    if isinstance(timestamps, np.ndarray):
+        timestamps = np.sort(timestamps.astype(np.int64, copy=False))
+    else:
+        timestamps = np.array(sorted(timestamps), dtype=np.int64)
+    mask = _sorted_membership(query_range.timestamps, timestamps)
+    return QueryRange.from_arrays(query_range.query, query_range.timestamps[mask], query_range.samples[mask])
+
+def _intersect(range_one: QueryRange, range_two: QueryRange):
+    mask_one = _sorted_membership(range_one.timestamps, range_two.timestamps)
+    mask_two = _sorted_membership(range_two.timestamps, range_one.timestamps)
+    return range_one.timestamps[mask_one], range_one.samples[mask_one], range_two.samples[mask_two]
+
+def ratio(numerator: QueryRange, denominator: QueryRange, query: Optional[str] = None) -> QueryRange:
+    timestamps, numerator_samples, denominator_samples = _intersect(numerator, denominator)
+    # like promql, division by zero yields inf or nan rather than raising
+    with np.errstate(divide="ignore", invalid="ignore"):
+        samples = numerator_samples / denominator_samples
+    return QueryRange.from_arrays(query or f"{numerator.query} / {denominator.query}", timestamps, samples)
+
+def product(range_one: QueryRange, range_two: QueryRange, query: Optional[str] = None) -> QueryRange:
+    timestamps, samples_one, samples_two = _intersect(range_one, range_two)
+    return QueryRange.from_arrays(query or f"({range_one.query}) * ({range_two.query})", timestamps, samples_one * samples_two)
+
+def _nearest_positions(timestamps: np.ndarray, anchor: np.ndarray, tolerance: int):
+    # index of the closest sample to each anchor timestamp, ties resolve to the earlier sample
+    right = np.searchsorted(timestamps, anchor)
+    left = np.clip(right - 1, 0, timestamps.size - 1)
+    right = np.clip(right, 0, timestamps.size - 1)
+    use_right = np.abs(timestamps[right] - anchor) < np.abs(anchor - timestamps[left])
+    positions = np.where(use_right, right, left)
+    return positions, np.abs(timestamps[positions] - anchor) <= tolerance
+
+def _asof_positions(timestamps: np.ndarray, anchor: np.ndarray, tolerance: int):
+    # index of the last sample at or before each anchor timestamp, a tolerance of 0 means no staleness limit
+    positions = np.searchsorted(timestamps, anchor, side="right") - 1
+    found = positions >= 0
+    positions = np.clip(positions, 0, timestamps.size - 1)
+    if tolerance > 0:
+        found &= anchor - timestamps[positions] <= tolerance
+    return positions, found
+
+def _exact_positions(timestamps: np.ndarray, anchor: np.ndarray, tolerance: int):
+    positions = np.clip(np.searchsorted(timestamps, anchor), 0, timestamps.size - 1)
+    return positions, timestamps[positions] == anchor
+
+_JOINS = {
+    EXACT_JOIN: _exact_positions,
+    NEAREST_JOIN: _nearest_positions,
+    ASOF_JOIN: _asof_positions,
+}
+
+# aligns any number of ranges onto the timestamps of the first one, each input is matched in one vectorized pass:
+#   exact   - the sample must share the timestamp
+#   nearest - the closest sample within tolerance seconds
+#   asof    - the last sample at or before the timestamp, no older than tolerance (0 = unbounded)
+# timestamps that cannot be matched in every range are dropped
+def align(*query_ranges: QueryRange, mode: str = EXACT_JOIN, tolerance: int = 0) -> List[QueryRange]:
+    if mode not in _JOINS:
+        raise ValueError(f"unknown join mode: {mode}")
+    if not query_ranges:
+        return []
+    with span("align", mode=mode, ranges=len(query_ranges)) as align_span:
+        anchor = query_ranges[0].timestamps
+        if any(len(query_range) == 0 for query_range in query_ranges):
+            keep = np.zeros(anchor.shape, dtype=bool)
+            matches = [np.zeros(anchor.shape, dtype=np.int64) for _ in query_ranges]
+        else:
+            keep = np.ones(anchor.shape, dtype=bool)
+            matches = []
+            for query_range in query_ranges:
+                positions, found = _JOINS[mode](query_range.timestamps, anchor, tolerance)
+                keep &= found
+                matches.append(positions)
+        timestamps = anchor[keep]
+        align_span.set(samples=int(timestamps.size), dropped=int(anchor.size - timestamps.size))
+        return [
+            QueryRange.from_arrays(query_range.query, timestamps, query_range.samples[positions[keep]])
+            for query_range, positions in zip(query_ranges, matches)
+        ]
+
+def sum_ranges(query: str, query_ranges: Iterable[QueryRange]) -> QueryRange:
+    # promql style sum across series: a timestamp is kept when any series has a sample there
+    query_ranges = [query_range for query_range in query_ranges if len(query_range)]
+    if not query_ranges:
+        return QueryRange(query=query)
+    timestamps, positions = np.unique(np.concatenate([query_range.timestamps for query_range in query_ranges]), return_inverse=True)
+    samples = np.bincount(positions, weights=np.concatenate([query_range.samples for query_range in query_ranges]), minlength=timestamps.size)
+    return QueryRange.from_arrays(query, timestamps, samples)
+
+class SteadyWindow(NamedTuple):
+    load: int
+    start: datetime
+    end: datetime
+
+def steady_windows(phases: Iterable[Phase], rate_interval: str, settle: str = "0s", loads: Iterable[int] = ()) -> List[SteadyWindow]:
+    # the part of each phase where every rate window lies inside the phase, after a further settle period.
+    # phases too short to hold a steady window, or at levels not in loads, are left out
+    skip = timedelta(seconds=duration_to_seconds(rate_interval) + duration_to_seconds(settle))
+    loads = set(loads)
+    return [
+        SteadyWindow(phase.load, phase.start_time + skip, phase.end_time)
+        for phase in phases
+        if (not loads or phase.load in loads) and phase.start_time + skip < phase.end_time
+    ]
+
+async def score_windows(score_window: Callable[[datetime, datetime, Iterable[int]], Awaitable[ValidationResult]],
+                        windows: List[SteadyWindow], relevant_pids: Iterable[int]) -> ValidationResult:
+    # every window is fetched concurrently, the results are joined with the load level of each sample
+    relevant_pids = list(relevant_pids)
+    results = await asyncio.gather(*(score_window(window.start, window.end, relevant_pids) for window in windows))
+    if not results:
+        return ValidationResult(vq=ValidationQuery(actual_query_name="", predicted_query_name=""), predicted=np.array([]), actual=np.array([]),
+                                loads=np.array([], dtype=np.int64), timestamps=np.array([], dtype=np.int64))
+    return ValidationResult(
+        vq=results[0].vq,
+        predicted=np.concatenate([result.predicted for result in results]),
+        actual=np.concatenate([result.actual for result in results]),
+        loads=np.concatenate([np.full(len(result.actual), window.load, dtype=np.int64) for window, result in zip(windows, results)]),
+        timestamps=_concatenate_timestamps(results)
+    )
+
+def _concatenate_timestamps(results: List[ValidationResult]) -> Optional[np.ndarray]:
+    if any(result.timestamps is None for result in results):
+        return None
+    return np.concatenate([result.timestamps for result in results])